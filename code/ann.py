@@ -0,0 +1,149 @@
+# Approximate nearest neighbour index - an inverted file (IVF) over k-means coarse centroids, used in place of scanning the whole feature matrix
+
+# Import relevant libraries
+
+import os
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import MiniBatchKMeans
+from similarity import SimilarityEngine, normalize_rows, select_top
+import config
+
+"""
+Every feature row is assigned to the most similar of n_lists coarse centroids. A query is compared with the centroids
+first, and only the rows in its nprobe best lists are scored exactly, so a lookup touches roughly nprobe / n_lists of the
+archive. nprobe is the recall/latency knob (config.IVF_NPROBE) - recall_at_k measures it against the exact engine.
+The index is saved next to features.npz as ivf.npz:
+centroids = unit length float32 coarse centroids (n_lists x features)
+row_list = list number of every feature row
+list_ptr / list_rows = rows of each list, sorted by list then row (list l is list_rows[list_ptr[l]:list_ptr[l+1]])
+New papers are added by daily_collection.py with update(), which assigns the new rows to their closest centroid.
+"""
+
+INDEX_PATH = '../data/ivf.npz'
+SAMPLE = 100000
+
+# Function which rebuilds the list layout (offsets and sorted rows) from the list number of every row
+def layout(row_list, n_lists):
+    list_rows = np.argsort(row_list, kind='stable').astype(np.int32)
+    list_ptr = np.concatenate([[0], np.cumsum(np.bincount(row_list, minlength=n_lists))]).astype(np.int64)
+    return list_ptr, list_rows
+
+
+class IVFIndex:
+
+    def __init__(self, engine, centroids, row_list, nprobe=None):
+        self.engine = engine
+        self.centroids = centroids
+        self.row_list = row_list
+        self.list_ptr, self.list_rows = layout(row_list, len(centroids))
+        self.nprobe = nprobe or config.IVF_NPROBE
+
+    # Query rows normalized to unit length, in the precision of the feature matrix for dense features
+    def query(self, query_rows):
+        query = normalize_rows(query_rows)
+        if isinstance(self.engine.features, np.ndarray):
+            query = (query.toarray() if sparse.issparse(query) else query).astype(self.engine.features.dtype)
+        return query
+
+    # The nprobe lists closest to each query row (queries x nprobe)
+    def probe(self, query, nprobe):
+        cs = np.asarray(query @ self.centroids.T)
+        nprobe = min(nprobe, len(self.centroids))
+        return np.argpartition(-cs, nprobe - 1, axis=1)[:, :nprobe]
+
+    # Exact cosine scores of the query rows against a set of feature rows (queries x rows)
+    def exact(self, rows, query):
+        scores = self.engine.features[rows] @ query.T
+        if sparse.issparse(scores):
+            scores = scores.toarray()
+        return np.asarray(scores).T / self.engine.norms[rows]
+
+    # Same as SimilarityEngine.scores, but only rows in the probed lists are scored - all other rows get -inf
+    def scores(self, query_rows, start=0, stop=None, nprobe=None):
+        stop = self.engine.features.shape[0] if stop is None else stop
+        query = self.query(query_rows)
+        probed = self.probe(query, nprobe or self.nprobe)
+        allowed = np.zeros((len(probed), len(self.centroids)), dtype=bool)
+        np.put_along_axis(allowed, probed, True, axis=1)
+        block_lists = self.row_list[start:stop]
+        cand = np.flatnonzero(allowed.any(axis=0)[block_lists])
+        out = np.full((len(probed), stop - start), -np.inf)
+        if len(cand) > 0:
+            scores = self.exact(cand + start, query)
+            scores[~allowed[:, block_lists[cand]]] = -np.inf
+            out[:, cand] = scores
+        return out
+
+    # Exact scores against a set of rows that was already narrowed down (e.g. by journal, see recommend.prefiltered_scores)
+    def row_scores(self, query_rows, rows):
+        return self.engine.row_scores(query_rows, rows)
+
+    # Same as SimilarityEngine.top_k, scoring only the rows of each query's probed lists
+    def top_k(self, query_rows, k=5, threshold=None, exclude=None, start=0, stop=None, nprobe=None):
+        stop = self.engine.features.shape[0] if stop is None else stop
+        query = self.query(query_rows)
+        results = []
+        for i, lists in enumerate(self.probe(query, nprobe or self.nprobe)):
+            cand = np.concatenate([self.list_rows[self.list_ptr[x]:self.list_ptr[x + 1]] for x in lists]).astype(np.int64)
+            cand = cand[(cand >= start) & (cand < stop)]
+            if exclude is not None and len(exclude[i]) > 0:
+                cand = cand[~np.isin(cand, exclude[i])]
+            top, top_scores = select_top(self.exact(cand, query[i:i + 1])[0], k, threshold)
+            results.append((cand[top], top_scores))
+        return results
+
+    # Assign feature rows to their closest coarse centroid
+    def assign(self, rows):
+        return np.asarray(np.argmax(self.query(rows) @ self.centroids.T, axis=1)).ravel().astype(np.int32)
+
+    def save(self, path=INDEX_PATH):
+        np.savez(path + '.tmp.npz', centroids=self.centroids, row_list=self.row_list)
+        os.replace(path + '.tmp.npz', path)
+
+
+# Build an index from scratch. Coarse centroids are fit with mini-batch k-means on (a sample of) the unit length rows
+def build(engine, n_lists=None, sample=SAMPLE, seed=0):
+    n = engine.features.shape[0]
+    n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+    rows = np.sort(np.random.RandomState(seed).choice(n, min(n, sample), replace=False))
+    km = MiniBatchKMeans(n_clusters=min(n_lists, len(rows)), random_state=seed, n_init=3).fit(normalize_rows(engine.features[rows]))
+    centroids = normalize_rows(km.cluster_centers_).astype(np.float32)
+    index = IVFIndex(engine, centroids, np.zeros(0, dtype=np.int32))
+    index.row_list = np.concatenate([index.assign(engine.features[x:x + SAMPLE]) for x in range(0, n, SAMPLE)])
+    index.list_ptr, index.list_rows = layout(index.row_list, len(centroids))
+    return index
+
+# Load a saved index on top of an engine. Returns None if there is no index or it does not cover every row of the engine's matrix
+def load(engine, path=INDEX_PATH, nprobe=None):
+    if not os.path.exists(path):
+        return None
+    saved = np.load(path)
+    if len(saved['row_list']) != engine.features.shape[0]:
+        return None
+    return IVFIndex(engine, saved['centroids'], saved['row_list'], nprobe)
+
+# Add feature rows n_old: to the saved index (building it if it does not exist or does not match n_old) and save it
+def update(features, n_old, path=INDEX_PATH):
+    engine = SimilarityEngine(features)
+    index = None
+    if os.path.exists(path):
+        saved = np.load(path)
+        # Rows beyond n_old were assigned by a run whose load failed, and are dropped
+        if len(saved['row_list']) >= n_old:
+            index = IVFIndex(engine, saved['centroids'], saved['row_list'][:n_old])
+            index.row_list = np.concatenate([index.row_list, index.assign(features[n_old:])])
+            index.list_ptr, index.list_rows = layout(index.row_list, len(index.centroids))
+    if index is None:
+        index = build(engine)
+    index.save(path)
+    return index
+
+# Recall of the index's top k against the exact engine, averaged over sample query rows (each row's own paper excluded)
+def recall_at_k(index, rows, k=5, nprobe=None):
+    rows = np.asarray(rows)
+    exclude = [[x] for x in rows]
+    exact = index.engine.top_k(index.engine.features[rows], k, exclude=exclude)
+    approx = index.top_k(index.engine.features[rows], k, exclude=exclude, nprobe=nprobe)
+    found = [len(np.intersect1d(a[0], b[0])) / max(1, len(a[0])) for a, b in zip(exact, approx)]
+    return float(np.mean(found))
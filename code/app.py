@@ -1,6 +1,6 @@
 # Import flask and create the app class for WSGI implementation
 
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, g, has_request_context
 
 app = Flask(__name__)
 if __name__ == '__main__':
@@ -8,125 +8,282 @@ if __name__ == '__main__':
 
 # Import other necessary libraries    
 
+import threading
 from datetime import date, timedelta, datetime
-import pyodbc
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy import sparse
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
+from similarity import SimilarityEngine
+import feature_store
+import neighbours
+import recommend
+import embeddings
+import ann
+import text_index
+import catalog
+import summaries
+import results
+import paper_cache
+import metrics
+import tasks
+import config
+import db
+from db import get_db
 
 """
 Session variable reference:
 user = unique user id number, used for saving/referencing favorited papers
 f_id = list of paper ids in users favorites
-s_id = list of paper ids for the current search results list (or journal names for journal searching)
-s_no = reference number for index of s_id for the results display list to start with, since the page only shows 10 items at once
 r_id = list of paper ids of recommendations/similar articles to the current paper
 fr_id = list of paper ids for recommendations to the users favorites
-f_ch = Boolean for whether the favorites list has changed - signals app to recalculate daily recommendations
+f_ch = Boolean for whether the favorites list has changed - signals app to recalculate daily recommendations (instead of using the nightly user_recs table)
 l/r_message = Page specific errors/notification messages
-which_list = Tells which context the results screen is showing (favorites/search results/journals)
+Result lists (search results, journals, favorites) are not kept in the session - they are cached server side and the previous/next buttons carry a cursor to the page (see results.py)
 """
 
-# Load feature files (preprocessed during data collection)
-
-features = sparse.load_npz('../data/features.npz')
-
-# Function which converts SQL response object into dictionary {Paper id: [Paper title, paper journal]}
-def to_dict(sql):
-    pl = list(sql)
-    paper_dict = {x[-1]:[x[0],x[1]] for x in pl}
+# Time every request (histograms served at /metrics, see metrics.py)
+metrics.init_app(app)
+
+# Feature files (preprocessed during data collection) of one version of the feature store, and everything derived from them. vectors is the matrix used for similarity and clustering - the TF-IDF features, their SVD embeddings or the hashed features (config.FEATURE_SPACE)
+class FeatureState:
+
+    def __init__(self, manifest):
+        self.version = manifest['version']
+        self.features = feature_store.load(manifest=manifest)
+        self.vectors = embeddings.select(self.features)
+        engine = SimilarityEngine(self.vectors, norms=feature_store.load_norms(manifest=manifest) if self.vectors is self.features else None)
+        if config.SIMILARITY_BACKEND == 'ivf':
+            engine = ann.load(engine) or engine
+        self.engine = engine
+        self.neighbour_ids, self.neighbour_scores = neighbours.load(self.features.shape[0])
+        self.term_index = text_index.load(self.features.shape[0])
+        self.paper_catalog = catalog.load(self.features.shape[0])
+        self.paper_summaries = summaries.load(self.features.shape[0], self.vectors.shape[1])
+
+live = None
+live_lock = threading.Lock()
+
+# Load the features (memory-mapped from the feature store), reloading them when the nightly job has published a new version. One thread loads while the others wait, and the new state replaces the old one as a whole
+def load_features():
+    global live
+    with live_lock:
+        feature_store.bootstrap()
+        manifest = feature_store.read_manifest()
+        if live is None or live.version != manifest['version']:
+            live = FeatureState(manifest)
+
+load_features()
+
+# Each request works with the feature state it started with, so a reload during the request never mixes two versions
+@app.before_request
+def refresh_features():
+    if feature_store.version() != live.version:
+        load_features()
+    g.live = live
+    papers.check()
+
+# Feature state of the current request, or the live one outside of requests (e.g. background tasks)
+def loaded():
+    return g.get('live', live) if has_request_context() else live
+
+# Cache of paper rows (title, abstract, authors, journal, link, date) by paper id, cleared when the nightly job has changed the papers table (see paper_cache.py)
+papers = paper_cache.PaperCache()
+
+# Background recomputation of recommendations after favorites change
+recomputer = tasks.Recomputer()
+metrics.gauge('ajar_paper_cache_hit_ratio', 'Share of paper lookups answered from the paper cache', lambda: papers.stats()['hit_rate'])
+metrics.gauge('ajar_paper_cache_rows', 'Paper rows in the paper cache', lambda: papers.stats()['size'])
+
+# Function which converts cached paper rows into dictionary {Paper id: [Paper title, paper journal]}
+def to_dict(rows):
+    paper_dict = {x:[rows[x][0],rows[x][3]] for x in rows}
     return paper_dict
 
-# Function which determines length of object list and prepares the variables for displaying those results
-def init_list(results):
-    session['s_no'] = 0
-    if len(results) <= 10:
-        plen = len(results)
-        nex=False
-    else:
-        plen = 10
-        nex = True
-    return plen, nex
-
 # Returns papers most similar to the paper with id = pid by cosine similarity. Defaults to returning top five papers above the threshold score of 0.3
+# drop leaves the paper itself out of its own matches. With group=True, pid is a feature vector (or matrix row) instead of a paper id
+# Single papers are answered from the precomputed neighbour table when it covers the paper, otherwise they are scored live
+@metrics.timed('get_matches')
 def get_matches(pid, num=5, drop=True, group=False):
-    if not group:
-        pid = int(pid)
-        pid -= 1
-        pid = features[pid].toarray()
-    scores = cosine_similarity(pid, features)[0]
-    reverse = scores.copy()
-    reverse.sort()
-    reverse = reverse[::-1]
-    if drop:
-        top = reverse[1:num+1]
+    state = loaded()
+    exclude = None
+    if group:
+        query = pid
     else:
-        top = reverse[:num+1]
-    return [list(scores).index(x) + 1 for x in top if x > 0.3]
+        pid = int(pid) - 1
+        query = state.vectors[pid]
+        if drop:
+            stored = neighbours.lookup(state.neighbour_ids, state.neighbour_scores, pid, num, 0.3)
+            if stored is not None:
+                return [x + 1 for x in stored]
+            exclude = [[pid]]
+        else:
+            num += 1
+    rows, scores = state.engine.top_k(query, k=num, threshold=0.3, exclude=exclude)[0]
+    return [int(x) + 1 for x in rows]
 
-# Returns the papers most similar to a group of papers (list of ids) used for daily recommendations. Returns up to top 5 (default) papers with cosine score above 0.2 (lower threshold as quantity of papers is much lower for a daily pull
+# Returns the papers most similar to a group of papers (list of feature vectors) used for daily recommendations. Returns up to top 5 (default) papers with cosine score above 0.2 (lower threshold as quantity of papers is much lower for a daily pull)
+# All vectors are scored against the day's papers in one product, a paper's score being its best score against any of the vectors. Papers already in favorites (pids) are skipped
+@metrics.timed('comp_match')
 def comp_match(ids, pids, num=5):
     
-    # Get index numbers from SQL and pulls the corresponding feature rows (paper ids and feature matrix indices are synced)
-    rec_ids = list(cursor.execute("SELECT MIN(id), MAX(id) FROM papers WHERE date='" + session['date'] + "'").fetchall()[0])
-    if rec_ids[0] is None:
-        return []
-    rec_features = features[np.arange(rec_ids[0]-1,rec_ids[1]),:]
-    rows = rec_features.shape[0]
-    
-    # Placeholders/variables for results
-    scores = []
-    matches = []
-    over_threshold=True
-    x = 0
-    
-    # Calculate cosine similarities for each paper in ids (favorites) against each paper of the most recent day. Sort scores by ascending order in "reverse" list
-    for pf in ids:
-        scores += list(cosine_similarity([pf], rec_features)[0])
-    reverse = scores.copy()
-    reverse.sort()
-    reverse = reverse[::-1]
-    
-    # Moves down scores list and fetch corresponding paper id. If paper is not already in favorites or the results list, add to results. Once the number of papers is high enough or cosine scoree drops low enough, breaks loop  
-    while len(matches) < num and over_threshold:
-        score = reverse[x]
-        if score < 0.2:
-            over_threshold = False
-            break
-        index = scores.index(score)+1
-        mid = index%rows + rec_ids[0] - 1
-        if mid not in pids and mid not in matches:
-            matches.append(mid)
-        x += 1
-    
-    # Return nothing if no matches of sufficient quality were found, otherwise return list of recommended paper ids
-    if len(matches) == 0:
+    # Get index numbers from the paper catalog (or SQL) and score the corresponding feature rows (paper ids and feature matrix indices are synced)
+    state = loaded()
+    rec_ids = day_range(session['date'])
+    if rec_ids is None:
         return []
-    else:
-        return matches
+    return recommend.daily_matches(state.engine, ids, pids, rec_ids, num=num, journals=journal_filter(state), prefilter=config.JOURNAL_PREFILTER)
+
+# Id ranges [(first id, last id), ...] of the papers published on a day, from the paper catalog (or SQL). None if there are none
+def day_range(day):
+    paper_catalog = loaded().paper_catalog
+    if paper_catalog is not None:
+        return paper_catalog.day(day)
+    return catalog.id_ranges_of([x[0] for x in db.query(get_db(), 'day_ids', (day,))]) or None
+
+# Journal prefilter of the daily recommendations (config.JOURNAL_PREFILTER) - journal numbers of the feature rows and the journal centroids. None when it is off or the paper catalog/summaries are not loaded
+def journal_filter(state):
+    if config.JOURNAL_PREFILTER <= 0 or state.paper_catalog is None or state.paper_summaries is None:
+        return None
+    return state.paper_catalog.codes, state.paper_summaries.journal_unit
+
+# Background task run after a user's favorites change (see tasks.py) - the user's recommendations among the papers in the id ranges of a day
+def recompute_recs(user, fav_ids, ranges):
+    state = loaded()
+    fids = recommend.user_centroids(state.vectors, fav_ids, get_matches, user=user)
+    return recommend.daily_matches(state.engine, fids, fav_ids, ranges, journals=journal_filter(state), prefilter=config.JOURNAL_PREFILTER)
+
+# Answers a search from the in-process indexes - the paper catalog for the date/from/to/journal filters (see catalog.py) and the inverted index of the abstracts for the search terms (see text_index.py)
+# conditions are the parsed filters as (SQL condition, parameter), words the search terms. Words the inverted index does not know are answered by SQL and intersected with the rest
+# Returns paper ids (most relevant first when there are search terms, otherwise newest first), or None if the indexes cannot answer the search
+@metrics.timed('index_search')
+def index_search(conditions, words):
+    state = loaded()
+    paper_catalog, term_index = state.paper_catalog, state.term_index
+    if paper_catalog is None:
+        return None
+    terms, missing = ([], words) if term_index is None else term_index.split(words)
+    if (len(terms) == 0 and len(missing) > 0) or (len(words) == 0 and len(conditions) == 0):
+        return None
+
+    # Date filters are ranges of ids, the journal filter and unknown words are ascending id arrays
+    firsts = [conditions[x][1] for x in ['date', 'from'] if x in conditions]
+    lasts = [conditions[x][1] for x in ['date', 'to'] if x in conditions]
+    ranges = None
+    if len(firsts) + len(lasts) > 0:
+        ranges = paper_catalog.id_ranges(max(firsts) if len(firsts) > 0 else None, min(lasts) if len(lasts) > 0 else None)
+    candidates = None
+    if 'journal' in conditions:
+        candidates = paper_catalog.journal(conditions['journal'][1])
+    if len(missing) > 0:
+        sql_query = 'SELECT id FROM papers p WHERE ' + ' AND '.join(["p.abstract LIKE ?"] * len(missing))
+        found = np.sort(np.array([x[0] for x in db.query(get_db(), sql_query, ['%' + x + '%' for x in missing])], dtype=np.int64))
+        candidates = found if candidates is None else np.intersect1d(candidates, found, assume_unique=True)
+    if ranges is not None and candidates is not None:
+        candidates = candidates[catalog.in_ranges(candidates, ranges)]
+
+    if len(terms) == 0:
+        if candidates is None:
+            candidates = catalog.range_ids(ranges)
+        return [int(x) for x in candidates[::-1]]
+    start, stop = 0, term_index.shape[0]
+    if ranges is not None and candidates is None:
+        if len(ranges) == 1:
+            start, stop = ranges[0][0] - 1, ranges[0][1]
+        else:
+            candidates = catalog.range_ids(ranges)
+    rows = term_index.search(terms, start, stop, None if candidates is None else np.asarray(candidates, dtype=np.int64) - 1)
+    return [int(x) + 1 for x in rows]
 
 # Retrieve paper titles and journals for a range of paper ids in a list (list slice ids[start:stop]). If journals is called, then just returns slice of the original list (only need journal names)
-def get_plist(ids, start, stop, journal = False):
+@metrics.timed('get_plist')
+def get_plist(ids, start, stop, journal = False, cnxn = None):
     if len(ids) == 0:
         return []
     if journal:
         return ids[start:stop]
     else:
-        sql_query = "SELECT title, journal FROM papers WHERE id='"
-        for x in ids[start:stop]:
-            sql_query += str(x) + "' OR id='"
-        sql_query = sql_query[:-8]
-        sql_query += " ORDER BY id DESC"
-
-        return [[y[0], y[1]] for y in list(cursor.execute(sql_query).fetchall())]
+        # Titles come back in the order of ids (search results are ranked, not in id order)
+        page = [int(x) for x in ids[start:stop]]
+        found = to_dict(papers.get_many(cnxn or get_db(), page))
+        return [found[x] for x in page if x in found]
     
 app.secret_key = [REDACTED]
 
-# Establish connection to SQL server
-cnxn = pyodbc.connect('DRIVER={ODBC Driver 17 for SQL Server};SERVER=ga-cc12-s5.database.windows.net;DATABASE=capstone;UID=[REDACTED];PWD=[REDACTED]')
-cursor = cnxn.cursor()
+# Server-side cache of result lists, and the signed cursors of their pages
+result_cache = results.ResultCache()
+cursors = results.Cursors(app.secret_key)
+prefetcher = ThreadPoolExecutor(max_workers=2)
+metrics.gauge('ajar_result_cache_lists', 'Result lists in the result cache', lambda: len(result_cache.entries))
+
+# Template of each kind of result list
+RESULT_TEMPLATES = {'search': 'paper_list.html', 'journal': 'paper_list.html', 'journals': 'journals.html', 'favorites': 'favorites.html'}
+
+# Paper ids of a journal, newest first, from the paper catalog (or SQL table)
+def journal_papers(journal):
+    paper_catalog = loaded().paper_catalog
+    if paper_catalog is not None:
+        return [int(x) for x in paper_catalog.journal(journal)[::-1]]
+    return [x[0] for x in db.query(get_db(), 'journal_papers', (journal,))]
+
+# Unique list of journals matching every word of a journal search, from the paper catalog's journal name index (or the SQL table)
+def journal_names(search_string):
+    query = search_string.split()
+    paper_catalog = loaded().paper_catalog
+    if paper_catalog is not None:
+        return paper_catalog.find_journals(query)
+    sql_req = 'SELECT DISTINCT journal FROM papers WHERE ' + ' AND '.join(['journal LIKE ?'] * len(query))
+    return [x[0] for x in db.query(get_db(), sql_req, ['%' + word + '%' for word in query])]
+
+# Look up the titles of the page of a cached result list starting at offset, on a pool connection of its own (runs in the prefetch thread after the previous page is shown)
+def prefetch(entry, offset):
+    cnxn = db.pool.acquire()
+    try:
+        entry.titles[offset] = get_plist(entry.ids, offset, offset + results.PAGE, cnxn=cnxn)
+    finally:
+        db.pool.release(cnxn)
+
+# Result list (results.Entry) of a kind with its parameters - the user's favorites are read from the session, other lists are taken from the result cache or computed and cached
+def result_list(kind, params):
+    if kind == 'favorites':
+        return results.Entry(sorted(session['f_id'], reverse=True))
+    cache_key = results.key(kind, params, loaded().version)
+    entry = result_cache.get(cache_key)
+    if entry is None:
+        entry = result_cache.put(cache_key, results.Entry({'search': search_ids, 'journal': journal_papers, 'journals': journal_names}[kind](*params)))
+    return entry
+
+# Display the page of a result list starting at offset (10 items a page). The titles of the following page are looked up in the background and kept with the list for the next button
+# extra holds any further template values (e.g. the journal summary on the first page of a journal)
+def show_page(kind, params, offset, **extra):
+    entry = result_list(kind, params)
+    offset = max(0, min(offset, len(entry.ids) - 1))
+    ids = list(entry.ids[offset:offset + results.PAGE])
+    prev = offset > 0
+    nex = offset + results.PAGE < len(entry.ids)
+    if kind == 'journals':
+        titles = ids
+    else:
+        titles = entry.titles.get(offset)
+        if titles is None:
+            titles = get_plist(entry.ids, offset, offset + results.PAGE)
+        if nex and kind != 'favorites' and offset + results.PAGE not in entry.titles:
+            prefetcher.submit(prefetch, entry, offset + results.PAGE)
+    return render_template(RESULT_TEMPLATES[kind], start=np.arange(len(ids)), papers=titles, ids=ids, prev=prev, next_list=nex, l_message=session.get('l_message', ''),
+                           prevno=cursors.encode(kind, params, max(offset - results.PAGE, 0)), nextno=cursors.encode(kind, params, offset + results.PAGE), **extra)
+
+# Topic summary of a journal from the journal centroids (see summaries.py) - its papers closest to the centroid ({paper id: [title, journal]}, best first) and the journals with the closest centroids. Empty when the summaries are not loaded
+@metrics.timed('journal_summary')
+def journal_summary(journal):
+    state = loaded()
+    paper_catalog, paper_summaries = state.paper_catalog, state.paper_summaries
+    code = None if paper_catalog is None or paper_summaries is None else paper_catalog.by_name.get(journal.lower())
+    if code is None:
+        return {}
+    rep_ids, _ = paper_summaries.representative(state.vectors, paper_catalog.journal(journal), code)
+    related, _ = paper_summaries.related_journals(code)
+    return {'rep_ids': [int(x) for x in rep_ids], 'rep_papers': get_plist(rep_ids, 0, len(rep_ids)), 'related': [paper_catalog.journals[x] for x in related]}
+
+# SQL server connections - each request checks one out of the pool (get_db) and returns it when it ends (see db.py)
+db.init_app(app)
 
 # Log in page - clears session to erase persistent session variables to allow clean slate for new users logging in
 @app.route("/")
@@ -140,10 +297,10 @@ def login():
     user_input = request.args
     if user_input['button'] == 'login':
         # Check for errors - user already exists/incorrect passwords etc
-        if list(cursor.execute("SELECT COUNT(name) FROM users WHERE name = '" + user_input['name'] + "'").fetchall()[0])[0] == 0:
+        if db.query(get_db(), 'user_count', (user_input['name'],))[0][0] == 0:
             return render_template("home.html", error="No user found with that name")
         else:
-            info = list(cursor.execute("SELECT * FROM users WHERE name = '" + user_input['name'] + "'").fetchall()[0])
+            info = list(db.query(get_db(), 'user', (user_input['name'],))[0])
             if user_input['pass'] != info[2]:
                 return render_template("home.html", error="Incorrect user name/password combination")
             else:
@@ -170,14 +327,15 @@ def register():
         # Check for errors (duplicate user names, mismatched passwords, etc)
         if len(user_input['name']) == 0:
             return render_template('register.html', error='User name cannot be blank')
-        elif list(cursor.execute("SELECT COUNT(name) FROM users WHERE name = '" + user_input['name'] + "'").fetchall()[0])[0] > 0:
+        elif db.query(get_db(), 'user_count', (user_input['name'],))[0][0] > 0:
             return render_template('register.html', error='User name already exists')
         elif user_input['pass'] != user_input['passconf']:
             return render_template('register.html', error='Passwords do not match')
         else:
             # Assign unique user id number, add user to SQL database
-            new_id = list(cursor.execute("SELECT MAX(id) FROM users;").fetchall()[0])[0] + 1
-            cursor.execute("INSERT INTO users (id, name, pass) values (?,?,?)", new_id, user_input['name'], user_input['pass'])
+            cnxn = get_db()
+            new_id = db.query(cnxn, 'max_user_id')[0][0] + 1
+            db.execute(cnxn, 'add_user', (new_id, user_input['name'], user_input['pass']))
             cnxn.commit()
             session['user'] = new_id
         return redirect(url_for('user_home'))
@@ -191,121 +349,115 @@ def user_home():
         r_message = ''
         # Check for the presence of session variables - if not found, indicates this is the very first login, so assigns starting values for various session variables and calculates daily recommendations
         if 'f_id' not in session:
-            user_favs = [x[0] for x in cursor.execute("SELECT p_id FROM favs WHERE use_id = '" + str(session['user']) + "'").fetchall()]
+            user_favs = [x[0] for x in db.query(get_db(), 'favorites', (session['user'],))]
             if len(user_favs) == 0:
                 session['f_id'] = []
             else:
                 session['f_id'] = list(user_favs)
             session['f_ch'] = True
             session['date'] = (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-            session['p_num'] = list(cursor.execute("SELECT COUNT(*) FROM papers WHERE date='" + session['date'] + "'").fetchall()[0])[0]
+            paper_catalog = loaded().paper_catalog
+            if paper_catalog is not None:
+                session['p_num'] = paper_catalog.day_count(session['date'])
+            else:
+                session['p_num'] = db.query(get_db(), 'day_count', (session['date'],))[0][0]
             session['l_message'] = ''
+
+            # Use the recommendations precomputed by the nightly job (daily_recommendations.py) if there are any for this user. A p_id of 0 means the job found nothing of interest
+            stored = db.query(get_db(), 'user_recs', (session['user'], session['date']))
+            if len(stored) > 0:
+                session['fr_id'] = [x[0] for x in stored if x[0] != 0]
+                session['f_ch'] = False
+                if len(session['fr_id']) == 0:
+                    r_message = 'Did not find papers of interest from ' + datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y')
         fl = len(session['f_id'])
         
-        # Calculate daily recommendations based on the users favorited articles. Perform clustering if the number of favorites is greater than 5 (to hopefully provide more general recommendations for overall interests)
+        # Calculate daily recommendations based on the users favorited articles (clustered if there are more than 5, see recommend.user_centroids)
         if fl == 0:
             r_message = 'No articles saved. Favorite articles to receive daily recommendations'
             session['fr_id'] = []
             start = []
         elif session['f_ch']:
-            fids = [features[int(x)-1].toarray()[0] for x in session['f_id']]
-            # Adds variable - for low paper counts, we "bolster" the favorites with matching papers to each article and use that for clustering
-            if fl > 5:
-                if fl < 15:
-                    adds = 1
-                    if fl < 9:
-                        adds = 2
-                    for paper in session['f_id']:
-                        fids += [features[x-1].toarray()[0] for x in get_matches(paper, num=adds)]
-                best = 0
-                labels = []
-                fids = np.matrix(fids)
+            # Favorites changed - use the background recomputation scheduled by fave() if it is for the current favorites, showing the last recommendations until it is done
+            # A recomputation pending for too long was lost (see tasks.py), so the recommendations are computed here instead
+            state = recomputer.status(session['user'])
+            if state is not None and state['token'] == tasks.token(session['f_id'], session['date']) and not recomputer.stale(state):
+                if state['ready']:
+                    session['fr_id'] = state['ids']
+                    session['f_ch'] = False
+                    if len(session['fr_id']) == 0:
+                        r_message = 'Did not find papers of interest from ' + datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y')
+                else:
+                    session['fr_id'] = session.get('fr_id', state['ids'] or [])
+                    r_message = 'Updating your recommendations for your new favorites - refresh the page to see them'
+            else:
+                with metrics.span('user_centroids'):
+                    fids = recommend.user_centroids(loaded().vectors, session['f_id'], get_matches, user=session['user'])
                 
-                # Perform K-Means clustering with k ranging from 2 to 4: Selects the clustering with the highest silhouette score
-                for y in range(2,5):
-                    km = KMeans(n_clusters=y)
-                    km.fit(fids)
-                    sil = silhouette_score(fids, km.predict(fids))
-                    if sil > best:
-                        best = sil
-                        labels = km.labels_[:len(session['f_id'])]
-                grouped_features = []
-                for x in range(max(labels)+1):
-                    pgroup = fids[[y for y, z in enumerate(labels) if z == x],:]
-                    grouped_features.append(sum(map(np.array, pgroup)))
-                fids = grouped_features
-            
-            # Save recommendations, assign variables for html display
-            session['fr_id'] = comp_match(fids, session['f_id'])
+                # Save recommendations, assign variables for html display
+                session['fr_id'] = comp_match(fids, session['f_id'])
+                start = np.arange(len(session['fr_id']))
+                if len(session['fr_id']) == 0:
+                    r_message = 'Did not find papers of interest from ' + datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y')
+                session['f_ch'] = False
             session.modified=True
-            start = np.arange(len(session['fr_id']))
-            if len(session['fr_id']) == 0:
-                r_message = 'Did not find papers of interest from ' + datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y')
-            session['f_ch'] = False
 
-        session['which_list'] = ''
         session['r_id'] = {}
-        titles = get_plist(session['fr_id'], 0, len(session['fr_id']))
-        return render_template('user_home.html', start = np.arange(len(session['fr_id'])), papers=titles, ids=sorted(session['fr_id'],reverse=True), rec_message=r_message, number=session['p_num'], date=datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y'))
-
-# Main search function - breaks up query by spaces and searches for search keywords - all other words are treated as search terms
+        rec_ids = sorted(session['fr_id'], reverse=True)
+        titles = get_plist(rec_ids, 0, len(rec_ids))
+        return render_template('user_home.html', start = np.arange(len(session['fr_id'])), papers=titles, ids=rec_ids, rec_message=r_message, number=session['p_num'], date=datetime.strptime(session['date'], "%Y-%m-%d").strftime('%B %d, %Y'))
+
+# Paper ids for a search query - breaks up query by spaces and searches for search keywords - all other words are treated as search terms
+def search_ids(query):
+    words = query.split()
+    conditions = {}
+    search_words = []
+    for word in words:
+        word = word.lower()
+        # Search for keywords by presence of colon. Parses argument into a condition and its parameter (dates are stored as YYYY-MM-DD strings, so they compare in date order)
+        if ':' in word:
+            if 'date' in word:
+                conditions['date'] = ("p.date = ?", word[-10:])
+            elif 'from' in word:
+                conditions['from'] = ("p.date >= ?", word[-10:])
+            elif 'to' in word:
+                conditions['to'] = ("p.date <= ?", word[-10:])
+            elif 'journal' in word:
+                conditions['journal'] = ("p.journal = ?", word[8:])
+        else:
+            search_words.append(word)
+
+    # Searches with terms are answered from the inverted index, most relevant first
+    ranked = index_search(conditions, search_words)
+    if ranked is None:
+        # Otherwise create full SQL query from parsed segments (newest first)
+        clauses = [conditions[x] for x in ['date', 'from', 'to', 'journal'] if x in conditions] + [("p.abstract LIKE ?", '%' + x + '%') for x in search_words]
+        if len(clauses) == 0:
+            return []
+        sql_query = 'SELECT id FROM papers p WHERE ' + ' AND '.join([x[0] for x in clauses]) + ' ORDER BY id DESC'
+        ranked = [x[0] for x in db.query(get_db(), sql_query, [x[1] for x in clauses])]
+    return ranked
+
+# Main search function - shows the first page of the search results (kept in the result cache for the following pages)
 @app.route("/search")
 def search():
     query = request.args['query']
     if len(query) == 0:
         return redirect(url_for('user_home'))
     else:
-        words = query.split()
-        date, from_date, to_date, journal, terms = '','','','',''
-        for word in words:
-            word = word.lower()
-            # Search for keywords by presence of colon. Parses argument and creates appropriate SQL syntax
-            if ':' in word:
-                if 'date' in word:
-                    date = "p.date='" + word[-10:] + "'"
-                elif 'from' in word:
-                    from_date = "CONVERT(date, p.date) >= CONVERT(date, '" + word[-10:] + "')"
-                elif 'to' in word:
-                    to_date = "CONVERT(date, p.date) <= CONVERT(date, '" + word[-10:] + "')"
-                elif 'journal' in word:
-                    journal = "p.journal='" + word[8:] + "'"
-            else:
-                terms += "p.abstract LIKE '%" + word + "%' AND "
-        if len(terms) > 0:
-            terms = terms[:-5]
-        
-        # Create full SQL query string from parsed segments
-        sql_query = 'SELECT id FROM papers p WHERE '
-        for x in [date, from_date, to_date, journal, terms]:
-            if len(x) > 0:
-                sql_query += x + ' AND '
-        sql_query = sql_query[:-5]
-        sql_query += ' ORDER BY id DESC'
-        
-        # Save paper ids for the search results and points result page to article search (which_list key)
-        session['s_id'] = [x[0] for x in list(cursor.execute(sql_query).fetchall())]
-        session['which_list'] = 'paper_list.html'
-        if len(session['s_id']) == 0:
+        entry = result_list('search', (query,))
+        if len(entry.ids) == 0:
             return render_template('paper_list.html', start=[], papers=[], ids=[], prev=False, next_list=False, l_message="No articles matched your search criteria")
-        
-        # Initialize variables for html display
-        plen, nex = init_list(session['s_id'])
-        if nex:
-            nex_num = 10
-        else:
-            nex_num = 0
-        session['l_message'] = "Displaying " + str(len(session['s_id'])) + " articles for your search: " + query
-        session.modified = True
-        titles = get_plist(session['s_id'], 0, plen)
-        return render_template('paper_list.html', start=np.arange(0, plen), papers=titles, ids=session['s_id'], prev=False, next_list=nex, l_message=session['l_message'], nextno=nex_num)
+        session['l_message'] = "Displaying " + str(len(entry.ids)) + " articles for your search: " + query
+        return show_page('search', (query,), 0)
 
 # Function for displaying information on individual papers as well as list of similar articles
 @app.route("/s_display")
 def s_display():
     paper_id = int(request.args['button'])
     
-    # Pull information from SQL database
-    info = list(cursor.execute("SELECT * FROM papers WHERE id = '" + str(paper_id) + "'").fetchall()[0])
+    # Pull information from the paper cache (or SQL database)
+    info = papers.get(get_db(), paper_id)
     r_ids, r_titles = [],[]
     
     # Set favorite/unfavorite button context depending on if it's favorited already or not
@@ -318,11 +470,7 @@ def s_display():
     match_ids = get_matches(paper_id)
     if len(match_ids)!=0:
         message=''
-        sql_query = "SELECT title, journal, id FROM papers WHERE id='"
-        for x in match_ids:
-            sql_query += str(x) + "' OR id='"
-        sql_query = sql_query[:-8]
-        session['r_id']=to_dict(cursor.execute(sql_query).fetchall())
+        session['r_id']=to_dict(papers.get_many(get_db(), match_ids))
         session.modified=True
         r_ids = sorted(list(session['r_id'].keys()))
         r_ids = r_ids[::-1]
@@ -334,35 +482,14 @@ def s_display():
     return render_template('paper.html', title=info[0], abstract=info[1], authors=info[2], journal=info[3], link=info[4], date="Published on " + datetime.strptime(info[5], "%Y-%m-%d").strftime('%B %d, %Y'), favor=fav, pid=paper_id,
                            start=np.arange(len(session['r_id'])), papers=r_titles, ids=r_ids, no_sim=message)
 
-# Main results navigation function (previous, next buttons). The session[which_list] variable is for this function, as it tells this function which results screen to display
+# Main results navigation function (previous, next buttons). The buttons carry a cursor which tells this function which result list and page to display
 @app.route("/search_move")
 def next_search():
-    user_input = request.args
-    prev, nex = True, True
-    prev_num, nex_num = 0, 0
-    
-    # Reassign pointer to new index in the list, then calculates where the new points where the previous/next buttons refer to and whether they should be displayed or not (front/end of list)
-    session['s_no'] = int(user_input['button'])
-    if session['s_no'] < 10:
-        prev = False
-    else:
-        prev_num = session['s_no']-10
-    start = session['s_no']
-    remain = len(session['s_id']) - start
-    if remain <= 10:
-        plen = remain
-        nex=False
-    else:
-        remain = 10
-        nex_num = session['s_no'] + 10
-    journal = False
-    
-    # Conditional for journal list, which differs from the normal paper results
-    if session['which_list'] == 'journals.html':
-        journal = True
-    info = get_plist(session['s_id'], start, start+remain, journal)
-    titles = ([0]*start) + info
-    return render_template(session['which_list'], start=np.arange(start, start + remain), papers=titles, ids=session['s_id'], prev=prev, next_list=nex, l_message=session['l_message'], prevno=prev_num, nextno=nex_num)
+    cursor = cursors.decode(request.args['button'])
+    if cursor is None:
+        return redirect(url_for('user_home'))
+    kind, params, offset = cursor
+    return show_page(kind, params, offset)
 
 # Redirect function for the top bar navigation buttons that move the user from section to section
 @app.route("/nav_menu")
@@ -373,22 +500,28 @@ def nav_menu():
 @app.route("/fave")
 def fave():
     pid = str(int(request.args['button']))
-    info = list(cursor.execute("SELECT * FROM papers WHERE id = '" + pid + "'").fetchall()[0])
+    cnxn = get_db()
+    info = papers.get(cnxn, pid)
     
     # Remove from favorites and deletes from SQL table if favorited
     if int(pid) in session['f_id']:
-        cursor.execute("DELETE FROM favs WHERE p_id = '" + pid + "' AND use_id='" + str(session['user']) + "'")
+        db.execute(cnxn, 'remove_favorite', (int(pid), session['user']))
         session['f_id'].remove(int(pid))
         fav="Favorite"
     # Performs opposite if not in favorites
     else:
-        cursor.execute("INSERT INTO favs (use_id, p_id, title, journal) values (?,?,?,?)", session['user'], pid, info[0], info[3])
+        db.execute(cnxn, 'add_favorite', (session['user'], int(pid), info[0], info[3]))
         session['f_id'].append(int(pid))
         fav="Unfavorite"
         
+    # Precomputed recommendations no longer reflect the favorites, so they are recomputed in the background (rapid toggles are debounced into one recomputation, see tasks.py) and user_home picks them up when they are ready
+    db.execute(cnxn, 'clear_user_recs', (session['user'],))
     session['f_ch'] = True
     session.modified=True
     cnxn.commit()
+    day_ids = day_range(session['date']) if 'date' in session else None
+    if len(session['f_id']) > 0 and day_ids is not None:
+        recomputer.schedule(session['user'], tasks.token(session['f_id'], session['date']), recompute_recs, session['user'], list(session['f_id']), day_ids)
 
     # Carry over recommendations from original display and pushes out the HTML
     if len(session['r_id'])==0:
@@ -406,24 +539,11 @@ def fave():
 # Display list of all saved papers. Similar to search results display in terms of function
 @app.route("/favorites")
 def favorites(s_number=0):
-    plen, nex = init_list(session['f_id'])
-    if nex:
-        nextnum=10
-    else:
-        nextnum=0
-    session['s_id'] = session['f_id']
-    session['s_no'] = s_number
-    session['which_list'] = 'favorites.html'
-    session['f_ch'] = True
     if len(session['f_id']) == 0:
-        dele = False
-        message = "No saved articles. Favorite articles to receive daily recommendations"
+        session['l_message'] = "No saved articles. Favorite articles to receive daily recommendations"
     else:
-        dele = True
-        message = "Your saved articles"
-    session['s_id'] = sorted(session['s_id'], reverse=True)
-    titles = get_plist(session['s_id'], 0, plen)
-    return render_template('favorites.html', start=np.arange(0, plen), papers=titles, ids=session['s_id'], prev=False, next_list=nex, l_message=message, nextno=nextnum)
+        session['l_message'] = "Your saved articles"
+    return show_page('favorites', (), s_number)
 
 # Display the about page - no functionality, static text
 @app.route("/about")
@@ -444,42 +564,21 @@ def search_journals():
     if len(query) == 0:
         return render_template('journals.html')
     
-    # Retrieve unique list of journals matching search terms from SQL table
-    sql_req = 'SELECT DISTINCT journal FROM papers WHERE '
-    for word in query:
-        sql_req += "journal LIKE '%" + word + "%' AND "
-    sql_req = sql_req[:-5]
-    session['s_id'] = [x[0] for x in list(cursor.execute(sql_req).fetchall())]
-    
-    # Assign variables for HTML display, pointers for search navigation
-    plen, nex = init_list(session['s_id'])
-    if nex:
-        nextnum=10
-    else:
-        nextnum = 0
-    session['which_list'] = 'journals.html'
-    if len(session['s_id']) == 0:
+    # Retrieve unique list of journals matching search terms (see journal_names), assign message for HTML display
+    entry = result_list('journals', (search_string,))
+    if len(entry.ids) == 0:
         session['l_message'] = "No journals matched your search criteria"
     else:
-        session['l_message'] = "Displaying " + str(len(session['s_id'])) + " journals for your search: " + search_string
-    return render_template('journals.html', start=np.arange(0,plen), papers=session['s_id'], ids=session['s_id'], prev=False, next_list=nex, l_message=session['l_message'], nextno=nextnum)
+        session['l_message'] = "Displaying " + str(len(entry.ids)) + " journals for your search: " + search_string
+    return show_page('journals', (search_string,), 0)
 
 # Function for displaying list of papers from a particular journal, similar to using the search parameter "journal:"
 @app.route("/j_display")
 def j_display():
     journal = request.args['button']
     
-    # Pull papers with matching journal from SQL table
-    session['s_id'] = [x[0] for x in list(cursor.execute("SELECT id FROM papers WHERE journal = '" + journal + "' ORDER BY id DESC").fetchall())]
-    
-    # Assign variables for HTML display, points for search navigation
-    session['which_list']='paper_list.html'
-    plen, nex = init_list(session['s_id'])
-    if nex:
-        nextnum=10
-    else:
-        nextnum=0
-    session['l_message'] = "Displaying " + str(len(session['s_id'])) + " articles published in " + journal
-    titles = get_plist(session['s_id'], 0, plen)
-    return render_template('paper_list.html', start=np.arange(0,plen), papers=titles, ids=session['s_id'], prev=False, next_list=nex, l_message=session['l_message'], nextno=nextnum)
+    # Pull papers with matching journal (see journal_papers), assign message for HTML display. The first page also shows the journal's most representative papers and related journals (see journal_summary)
+    entry = result_list('journal', (journal,))
+    session['l_message'] = "Displaying " + str(len(entry.ids)) + " articles published in " + journal
+    return show_page('journal', (journal,), 0, **journal_summary(journal))
 
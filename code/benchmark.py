@@ -0,0 +1,248 @@
+# Benchmark suite for the recommendation hot paths - similarity lookup, user clustering, daily recommendations and nightly ingestion on a synthetic corpus, compared against a stored baseline
+
+# Import relevant libraries
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from similarity import SimilarityEngine
+import recommend
+import cluster_cache
+import feature_store
+import neighbours
+import text_index
+import catalog
+import loader
+
+"""
+Usage (from the code directory): python benchmark.py [--size small|medium|large] [--save file] [--baseline file]
+The corpus is generated, not loaded: SIZES papers over a VOCAB term vocabulary, each paper about one of TOPICS topics.
+Paper lengths are Poisson around DOC_LENGTH terms. Most terms are drawn from a Zipfian distribution over the whole
+vocabulary and the rest from the paper's topic, then weighted by TF-IDF and L2 normalized like the vectorizer's output
+(features.npz). Users get 1-50 favorites drawn from 1-3 topics. The last DAY papers play the part of the latest day.
+Everything runs in memory or in a temporary directory (SQLite stands in for SQL Server), and the seed is fixed, so two
+runs of the same size measure the same work.
+Each benchmark reports the best wall time of --repeat runs (fresh setup for every run), and the peak memory allocated
+during one further run under tracemalloc. With --baseline, the results are compared to a saved run and the script exits
+with status 1 if any benchmark is more than TOLERANCE slower.
+"""
+
+SIZES = {'small': 20000, 'medium': 200000, 'large': 2000000}
+VOCAB = 10000
+TOPICS = 200
+TOPIC_TERMS = 200
+DOC_LENGTH = 100
+ZIPF = 1.07
+TOPIC_SHARE = 0.3
+DAY = 1000
+USERS = 200
+QUERIES = 200
+TOLERANCE = 0.2
+
+
+# Synthetic TF-IDF corpus of n papers. Returns the feature matrix (float64 CSR, unit rows) and the topic of every paper
+def corpus(n, vocab=VOCAB, seed=0, chunk=20000):
+    rng = np.random.default_rng(seed)
+    zipf = 1 / np.arange(1, vocab + 1) ** ZIPF
+    zipf = zipf / zipf.sum()
+    topic_terms = np.array([rng.choice(vocab, TOPIC_TERMS, replace=False) for x in range(TOPICS)])
+    topics = rng.integers(0, TOPICS, n)
+    parts = []
+    for start in range(0, n, chunk):
+        m = min(chunk, n - start)
+        lengths = rng.poisson(DOC_LENGTH, m) + 1
+        rows = np.repeat(np.arange(m), lengths)
+        terms = rng.choice(vocab, size=len(rows), p=zipf)
+        from_topic = rng.random(len(rows)) < TOPIC_SHARE
+        terms[from_topic] = topic_terms[topics[start + rows[from_topic]], rng.integers(0, TOPIC_TERMS, from_topic.sum())]
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, terms)), shape=(m, vocab))
+        counts.sum_duplicates()
+        parts.append(counts)
+    counts = sparse.vstack(parts, format='csr')
+    idf = np.log((1 + n) / (1 + np.bincount(counts.indices, minlength=vocab))) + 1
+    features = sparse.csr_matrix(counts.multiply(idf))
+    norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+    features = sparse.csr_matrix(sparse.diags(1 / np.maximum(norms, 1e-12)) @ features)
+    return features, topics
+
+# Synthetic users - favorite paper ids (1-50 of them, from 1-3 topics) for each user
+def users(topics, n_users=USERS, seed=1):
+    rng = np.random.default_rng(seed)
+    by_topic = [np.flatnonzero(topics == x) for x in range(TOPICS)]
+    favorites = []
+    for user in range(n_users):
+        liked = rng.choice(TOPICS, rng.integers(1, 4), replace=False)
+        pool = np.concatenate([by_topic[x] for x in liked])
+        favorites.append(sorted(int(x) + 1 for x in rng.choice(pool, min(len(pool), rng.integers(1, 51)), replace=False)))
+    return favorites
+
+
+# Time run(setup()) repeat times (fresh setup each time, not timed), then once more under tracemalloc for the peak memory
+def measure(run, setup=lambda: None, repeat=3):
+    times = []
+    for x in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    run(args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': round(min(times), 4), 'peak_mb': round(peak / 2 ** 20, 2)}
+
+# get_matches - top 5 similar papers for one paper at a time
+def bench_similarity(engine, rows):
+    def run(args):
+        for row in rows:
+            engine.top_k(engine.features[row], k=5, threshold=0.3, exclude=[[row]])
+    return run
+
+# user_home clustering - every user's centroids fitted from scratch (cold) or updated from their cached clusters after one new favorite (warm)
+def bench_clustering(engine, favorites, cache_dir=None):
+    def matches(pid, num=5):
+        rows, scores = engine.top_k(engine.features[int(pid) - 1], k=num, threshold=0.3, exclude=[[int(pid) - 1]])[0]
+        return [int(x) + 1 for x in rows]
+
+    def run(args):
+        for user, favs in enumerate(favorites):
+            if cache_dir is None:
+                recommend.user_centroids(engine.features, favs, matches)
+            else:
+                cluster_cache.centroids(user, engine.features, favs + [args[user]], matches, cache_dir)
+
+    def setup():
+        if cache_dir is None:
+            return None
+        # Cache every user's clusters without the favorite added in the timed run
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+        for user, favs in enumerate(favorites):
+            cluster_cache.centroids(user, engine.features, favs, matches, cache_dir)
+        return [max(favs) % (engine.features.shape[0] - 1) + 1 for favs in favorites]
+    return run, setup
+
+# daily_recommendations - every user's centroids scored against the day's papers in one batch
+def bench_recommendations(engine, centroids, favorites, start, stop):
+    def run(args):
+        recommend.batch_daily_matches(engine, centroids, favorites, [(start + 1, stop)])
+    return run
+
+# daily_collection after the text pipeline - publish the day's feature shard, update the neighbour table, inverted index and catalog, and bulk insert the papers into SQLite
+def bench_ingestion(features, n_old, workdir):
+    old, new = features[:n_old], features[n_old:]
+    day = pd.DataFrame({'title': ['Paper ' + str(x) for x in range(n_old + 1, features.shape[0] + 1)], 'abstract': 'abstract', 'link': 'link',
+                        'date': '2020-09-09', 'journal': 'Journal', 'authors': 'Author', 'id': np.arange(n_old + 1, features.shape[0] + 1)})
+
+    def setup():
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        store = os.path.join(workdir, 'features')
+        os.makedirs(os.path.join(store, 'shards'))
+        feature_store.append(old, 'base', store)
+
+        # The stored neighbour table is random - its contents do not change the work done for the new papers
+        rng = np.random.default_rng(2)
+        np.save(os.path.join(workdir, 'ids.npy'), rng.integers(0, n_old, (n_old, neighbours.K)).astype(np.int32))
+        np.save(os.path.join(workdir, 'scores.npy'), -np.sort(-rng.random((n_old, neighbours.K)), axis=1).astype(np.float32))
+        neighbours.write_meta(os.path.join(workdir, 'ids.npy'))
+        text_index.update(old, 0, os.path.join(workdir, 'search'))
+        state = {'rows': 0, 'blocks': [], 'journals': [], 'codes': np.array([], dtype=np.int32)}
+        catalog.save(catalog.add(state, list(range(1, n_old + 1)), ['2020-09-08'] * n_old, ['Journal'] * n_old), os.path.join(workdir, 'catalog.pkl'))
+
+        # The papers table only needs its highest id for the loader's check
+        cnxn = sqlite3.connect(os.path.join(workdir, 'papers.db'))
+        cnxn.execute("CREATE TABLE papers (title TEXT, abstract TEXT, authors TEXT, journal TEXT, link TEXT, date TEXT, id INT)")
+        cnxn.execute("INSERT INTO papers (title, id) values ('placeholder', ?)", (n_old,))
+        cnxn.commit()
+        return cnxn, store
+
+    def run(args):
+        cnxn, store = args
+        all_features = feature_store.extend(feature_store.load(store), new)
+        neighbours.update(all_features, n_old, os.path.join(workdir, 'ids.npy'), os.path.join(workdir, 'scores.npy'))
+        text_index.update(all_features, n_old, os.path.join(workdir, 'search'))
+        catalog.update(cnxn, day, n_old, os.path.join(workdir, 'catalog.pkl'))
+        loader.load_papers(cnxn, day, lambda: feature_store.append(new, 'day', store), n_old, store)
+        cnxn.close()
+    return run, setup
+
+# Run every benchmark on a corpus of n papers
+def run_all(n, repeat=3, n_users=USERS, day=DAY):
+    results = {}
+    start = time.perf_counter()
+    features, topics = corpus(n)
+    favorites = users(topics[:n - day], n_users)
+    print('corpus: ' + str(n) + ' papers, ' + str(features.nnz) + ' non-zeros (' + str(round(time.perf_counter() - start, 1)) + 's to generate)')
+    engine = SimilarityEngine(features)
+    rows = np.random.default_rng(3).choice(n, min(QUERIES, n), replace=False)
+    workdir = tempfile.mkdtemp(prefix='ajar_benchmark_')
+    try:
+        results['similarity_top_k'] = measure(bench_similarity(engine, rows), repeat=repeat)
+        run, setup = bench_clustering(engine, favorites)
+        results['clustering_cold'] = measure(run, setup, repeat)
+        run, setup = bench_clustering(engine, favorites, os.path.join(workdir, 'clusters'))
+        results['clustering_warm'] = measure(run, setup, repeat)
+        centroids = [cluster_cache.load(user, os.path.join(workdir, 'clusters'))['sums'] for user in range(len(favorites))]
+        results['daily_recommendations'] = measure(bench_recommendations(engine, centroids, favorites, n - day, n), repeat=repeat)
+        run, setup = bench_ingestion(features, n - day, os.path.join(workdir, 'ingest'))
+        results['ingestion'] = measure(run, setup, repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+# Print the results next to the baseline's. Returns the names of the benchmarks that got more than tolerance slower
+def compare(results, baseline, tolerance=TOLERANCE):
+    slower = []
+    print('benchmark'.ljust(24) + 'seconds'.rjust(10) + 'baseline'.rjust(10) + 'change'.rjust(9) + 'peak MB'.rjust(10) + 'baseline'.rjust(10))
+    for name, result in results.items():
+        base = baseline.get(name)
+        line = name.ljust(24) + str(result['seconds']).rjust(10)
+        if base is None:
+            print(line)
+            continue
+        change = result['seconds'] / base['seconds'] - 1 if base['seconds'] > 0 else 0.0
+        line += str(base['seconds']).rjust(10) + (('+' if change >= 0 else '') + str(round(100 * change, 1)) + '%').rjust(9)
+        line += str(result['peak_mb']).rjust(10) + str(base['peak_mb']).rjust(10)
+        if change > tolerance:
+            slower.append(name)
+            line += '  SLOWER'
+        print(line)
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the recommendation hot paths on a synthetic corpus')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file (from --save)')
+    args = parser.parse_args()
+
+    results = run_all(SIZES[args.size], args.repeat, args.users)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved['papers'] != SIZES[args.size]:
+            print('baseline is for ' + str(saved['papers']) + ' papers, not comparing')
+        else:
+            baseline = saved['results']
+    slower = compare(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'papers': SIZES[args.size], 'results': results}, f, indent=1)
+    if len(slower) > 0:
+        print('slower than the baseline: ' + ', '.join(slower))
+        sys.exit(1)
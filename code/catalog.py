@@ -0,0 +1,178 @@
+# Paper catalog - in-process date and journal indexes over the paper ids, so date ranges, journal listings and journal name searches need no SQL scan
+
+# Import relevant libraries
+
+import os
+import bisect
+import pickle
+import numpy as np
+
+"""
+Papers are inserted one day at a time with consecutive ids, so each publication date is a block of ids (a day that was
+ingested twice has two blocks). The catalog keeps:
+blocks = (date, first id, last id) for every ingested block, sorted by date - a date or date range is a bisect over them
+journals = the distinct journal names, and codes = the journal number of every paper (row = paper id - 1), from which
+           the ids of each journal are grouped once at load time (journal -> ascending id array)
+trigrams = trigram of a lower case journal name -> journal numbers, so a journal name search only checks the names that
+           share every trigram of the search words
+It is saved as one pickle at ../data/catalog.pkl and extended by the nightly collection with the day's papers. The app
+loads it with the features and only uses it when it covers exactly the live papers (otherwise it falls back to SQL).
+"""
+
+CATALOG_PATH = '../data/catalog.pkl'
+
+
+class Catalog:
+
+    def __init__(self, rows, blocks, journals, codes):
+        self.rows = rows
+        self.blocks = blocks
+        self.dates = [x[0] for x in blocks]
+        self.journals = journals
+        self.codes = codes
+        self.by_name = {x.lower(): n for n, x in enumerate(journals)}
+
+        # Ids of each journal, grouped (ascending within each journal)
+        order = np.argsort(codes, kind='stable')
+        self.journal_ids = (order + 1).astype(np.int32)
+        self.journal_offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(journals)))]).astype(np.int64)
+
+        self.trigrams = {}
+        for n, name in enumerate(journals):
+            for gram in set(trigrams(name.lower())):
+                self.trigrams.setdefault(gram, []).append(n)
+
+    # Id ranges [(first id, last id), ...] of the papers published on a date - more than one when the day was ingested more than once - None if there are none
+    def day(self, day):
+        return self.id_ranges(day, day) or None
+
+    # Number of papers published on a date
+    def day_count(self, day):
+        lo, hi = bisect.bisect_left(self.dates, day), bisect.bisect_right(self.dates, day)
+        return sum(x[2] - x[1] + 1 for x in self.blocks[lo:hi])
+
+    # Id ranges [(first id, last id), ...] of the papers published between two dates (inclusive, either can be None for open ended), adjacent ranges merged, in id order
+    def id_ranges(self, first=None, last=None):
+        lo = 0 if first is None else bisect.bisect_left(self.dates, first)
+        hi = len(self.dates) if last is None else bisect.bisect_right(self.dates, last)
+        ranges = []
+        for _, a, b in sorted(self.blocks[lo:hi], key=lambda x: x[1]):
+            if len(ranges) > 0 and a == ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], b)
+            else:
+                ranges.append((a, b))
+        return ranges
+
+    # Ascending ids of the papers of a journal (case insensitive exact name)
+    def journal(self, name):
+        n = self.by_name.get(name.lower())
+        if n is None:
+            return np.array([], dtype=np.int32)
+        return self.journal_ids[self.journal_offsets[n]:self.journal_offsets[n + 1]]
+
+    # Journal names containing every word (case insensitive), in alphabetical order
+    def find_journals(self, words):
+        words = [x.lower() for x in words]
+        candidates = None
+        for word in words:
+            for gram in trigrams(word):
+                found = set(self.trigrams.get(gram, []))
+                candidates = found if candidates is None else candidates & found
+        if candidates is None:
+            candidates = range(len(self.journals))
+        return sorted([self.journals[n] for n in candidates if all(x in self.journals[n].lower() for x in words)])
+
+
+# Every three character substring of a string
+def trigrams(text):
+    return [text[x:x + 3] for x in range(len(text) - 2)]
+
+# Function which converts ranges of ids into an ascending id array
+def range_ids(ranges):
+    if len(ranges) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate([np.arange(a, b + 1) for a, b in ranges])
+
+# Function which converts an ascending id array into ranges of consecutive ids, like Catalog.id_ranges returns
+def id_ranges_of(ids):
+    ranges = []
+    for x in ids:
+        if len(ranges) > 0 and x == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], x)
+        else:
+            ranges.append((x, x))
+    return ranges
+
+# Mask of the ids (ascending) that fall in any of the ranges returned by Catalog.id_ranges
+def in_ranges(ids, ranges):
+    if len(ranges) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    firsts, lasts = np.array([x[0] for x in ranges]), np.array([x[1] for x in ranges])
+    at = np.searchsorted(firsts, ids, side='right') - 1
+    return (at >= 0) & (ids <= lasts[np.maximum(at, 0)])
+
+# Add papers (ascending ids following on from the catalog, with their dates and journals) to the saved state
+def add(state, ids, dates, journals):
+    names = {x: n for n, x in enumerate(state['journals'])}
+    codes = []
+    for name in journals:
+        if name not in names:
+            names[name] = len(state['journals'])
+            state['journals'].append(name)
+        codes.append(names[name])
+    state['codes'] = np.concatenate([state['codes'], np.array(codes, dtype=np.int32)])
+
+    # One block per run of consecutive ids with the same date
+    for n in range(len(ids)):
+        if n > 0 and dates[n] == dates[n - 1] and ids[n] == ids[n - 1] + 1:
+            state['blocks'][-1] = (dates[n], state['blocks'][-1][1], int(ids[n]))
+        else:
+            state['blocks'].append((dates[n], int(ids[n]), int(ids[n])))
+    state['blocks'].sort()
+    state['rows'] += len(ids)
+    return state
+
+# Drop the papers from id n_rows + 1 onwards from the saved state (added by a run whose load failed), with the journals only they used
+def truncate(state, n_rows):
+    state['codes'] = state['codes'][:n_rows]
+    state['journals'] = state['journals'][:int(state['codes'].max()) + 1 if n_rows > 0 else 0]
+    state['blocks'] = [(d, a, min(b, n_rows)) for d, a, b in state['blocks'] if a <= n_rows]
+    state['rows'] = n_rows
+    return state
+
+# Write the catalog state atomically
+def save(state, path=CATALOG_PATH):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+# Build the catalog state from the papers table
+def build(cnxn):
+    state = {'rows': 0, 'blocks': [], 'journals': [], 'codes': np.array([], dtype=np.int32)}
+    rows = cnxn.cursor().execute("SELECT id, date, journal FROM papers ORDER BY id").fetchall()
+    if len(rows) > 0 and rows[-1][0] != len(rows):
+        raise RuntimeError('paper ids are not consecutive, cannot build the catalog')
+    return add(state, [x[0] for x in rows], [x[1] for x in rows], [x[2] for x in rows])
+
+# Add the day's papers (DataFrame with id, date and journal columns) to the saved catalog. If the catalog covers fewer than the n_old papers before them it is rebuilt from the papers table first, papers beyond them are dropped
+def update(cnxn, df, n_old, path=CATALOG_PATH):
+    state = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    if state is not None and state['rows'] > n_old:
+        truncate(state, n_old)
+    if state is None or state['rows'] != n_old:
+        state = build(cnxn)
+    add(state, [int(x) for x in df['id']], list(df['date']), list(df['journal']))
+    save(state, path)
+
+# Load the catalog. Returns None if it has not been built or does not cover the rows papers of the live features
+def load(rows=None, path=CATALOG_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if rows is not None and state['rows'] != rows:
+        return None
+    return Catalog(state['rows'], state['blocks'], state['journals'], state['codes'])
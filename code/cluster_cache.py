@@ -0,0 +1,160 @@
+# Per-user cache of favorite clusters, so a favorite being added or removed updates the clusters instead of refitting K-Means
+
+# Import relevant libraries
+
+import os
+import pickle
+import tempfile
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+
+"""
+Cluster state for each user is pickled to ../data/clusters/<user id>.pkl (outside of the session cookie):
+ids = favorite paper ids the state was built from
+labels = cluster number of each favorite
+sums = sparse matrix with one row per cluster, the sum of the features of its favorites (used as the centroid - cosine similarity ignores scale)
+counts = number of favorites in each cluster
+k = number of clusters chosen by silhouette score at the last full fit
+cohesion = mean cosine similarity of the favorites to their centroid at the last full fit
+Users with 5 or fewer favorites are not clustered - every favorite is its own "cluster".
+Adding a favorite puts it in the cluster with the closest centroid and removing one subtracts it from its cluster. The
+clusters are only refit (and k chosen again) when a cluster empties, the user crosses the 5 favorite mark, or the
+cohesion drops below DRIFT times its value at the last fit. All features stay sparse (or are the dense SVD embeddings).
+"""
+
+CACHE_DIR = '../data/clusters'
+DRIFT = 0.8
+
+# Load a user's cluster state, None if there is none yet
+def load(user, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, str(user) + '.pkl')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+# Save a user's cluster state (written to a temporary file first so a reader never sees a partial file). Each write has its own temporary file - request threads, background tasks, other app processes and the daily recommendations can save the same user at once, and the last one wins
+def save(user, state, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, str(user) + '.pkl')
+    with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=str(user) + '.', suffix='.tmp', delete=False) as f:
+        pickle.dump(state, f)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+# Feature rows of a list of paper ids (paper ids and feature matrix indices are synced). Dense embedding rows are also returned as a sparse matrix so the cluster arithmetic is the same for both feature spaces
+def rows(features, ids):
+    return sparse.csr_matrix(features[np.asarray(ids, dtype=np.int64) - 1])
+
+# Sum the rows of each label into a (k x features) sparse matrix
+def group_sums(matrix, labels, k):
+    onehot = sparse.csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(k, len(labels)))
+    return sparse.csr_matrix(onehot @ matrix)
+
+# Mean cosine similarity of each favorite to the centroid of its cluster
+def cohesion(matrix, labels, sums):
+    centroids = sums[labels]
+    dots = np.asarray(matrix.multiply(centroids).sum(axis=1)).ravel()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel() * np.asarray(centroids.multiply(centroids).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return float(np.mean(dots / norms))
+
+# Full fit of a user's favorites. For more than 5 favorites, K-Means with k ranging from 2 to 4 is fit and the clustering with the highest silhouette score is kept
+# Adds variable - for low paper counts, we "bolster" the favorites with matching papers to each article (matches(paper id, num) returns similar paper ids) and use that for clustering. Only favorites count towards the centroids
+def fit(features, fav_ids, matches):
+    fl = len(fav_ids)
+    favs = rows(features, fav_ids)
+    if fl <= 5:
+        labels = np.arange(fl)
+        k = fl
+    else:
+        extra = []
+        if fl < 15:
+            adds = 1
+            if fl < 9:
+                adds = 2
+            for paper in fav_ids:
+                extra += matches(paper, num=adds)
+        fids = sparse.vstack([favs, rows(features, extra)], format='csr') if len(extra) > 0 else favs
+        best = -1
+        for y in range(2, 5):
+            km = KMeans(n_clusters=y)
+            predicted = km.fit_predict(fids)
+            if len(set(predicted)) < 2:
+                continue
+            sil = silhouette_score(fids, predicted)
+            if sil > best:
+                best = sil
+                labels = predicted[:fl]
+        if best == -1:
+            labels = np.zeros(fl, dtype=np.int64)
+
+        # Renumber the clusters that contain favorites as 0..k-1 (clusters made only of bolstering papers are dropped)
+        kept, labels = np.unique(labels, return_inverse=True)
+        k = len(kept)
+    sums = group_sums(favs, labels, k)
+    return {'ids': list(fav_ids), 'labels': np.asarray(labels), 'sums': sums, 'counts': np.bincount(labels, minlength=k),
+            'k': k, 'cohesion': cohesion(favs, labels, sums)}
+
+# Bring a cached state up to date with the current favorites. Returns the updated state, or None if the clusters need a full fit
+def update(state, features, fav_ids):
+    old, new = set(state['ids']), set(fav_ids)
+    if len(old) <= 5 or len(new) <= 5:
+        return None
+    removed = [x for x in state['ids'] if x not in new]
+    added = [x for x in fav_ids if x not in old]
+    if len(removed) == 0 and len(added) == 0:
+        return state
+
+    ids = list(state['ids'])
+    labels = list(state['labels'])
+    sums = state['sums']
+    counts = state['counts'].copy()
+    k = state['k']
+
+    # Removing a favorite subtracts its features from its cluster
+    for pid in removed:
+        at = ids.index(pid)
+        label = labels[at]
+        sums = sums - group_sums(rows(features, [pid]), [label], k)
+        counts[label] -= 1
+        del ids[at], labels[at]
+    if np.any(counts == 0):
+        return None
+
+    # Adding a favorite puts it in the cluster with the most similar centroid
+    for pid in added:
+        row = rows(features, [pid])
+        centroid_norms = np.sqrt(np.asarray(sums.multiply(sums).sum(axis=1)).ravel())
+        centroid_norms[centroid_norms == 0] = 1
+        label = int(np.argmax((sums @ row.T).toarray().ravel() / centroid_norms))
+        sums = sums + group_sums(row, [label], k)
+        counts[label] += 1
+        ids.append(pid)
+        labels.append(label)
+
+    labels = np.asarray(labels)
+    if cohesion(rows(features, ids), labels, sums) < DRIFT * state['cohesion']:
+        return None
+    return {'ids': ids, 'labels': labels, 'sums': sparse.csr_matrix(sums), 'counts': counts, 'k': k, 'cohesion': state['cohesion']}
+
+# Cluster centroids (sparse, one row per cluster) for a user's favorites, using and refreshing the user's cached state
+def centroids(user, features, fav_ids, matches, cache_dir=CACHE_DIR):
+    fav_ids = [int(x) for x in fav_ids]
+    if len(fav_ids) == 0:
+        return sparse.csr_matrix((0, features.shape[1]))
+    state = load(user, cache_dir)
+    if state is not None and state['sums'].shape[1] != features.shape[1]:
+        # Cached in a different feature space (config.FEATURE_SPACE changed)
+        state = None
+    if state is not None:
+        state = update(state, features, fav_ids)
+    if state is None:
+        state = fit(features, fav_ids, matches)
+    save(user, state, cache_dir)
+    return state['sums']
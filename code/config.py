@@ -0,0 +1,60 @@
+# Settings shared by the app and the daily scripts. Each can be overridden with an environment variable of the same name prefixed with AJAR_
+
+import os
+
+# Feature space used for similarity and clustering - 'tfidf' for the sparse TF-IDF features, 'svd' for the dense TruncatedSVD embeddings built by daily_collection.py (see embeddings.py), 'hashing' for hashed term counts weighted by an IDF refreshed every day (see hashing.py)
+FEATURE_SPACE = os.environ.get('AJAR_FEATURE_SPACE', 'tfidf')
+
+# Number of dimensions of the SVD embeddings
+SVD_DIMENSIONS = int(os.environ.get('AJAR_SVD_DIMENSIONS', '300'))
+
+# Similarity backend for get_matches and comp_match - 'exact' scans every row, 'ivf' uses the approximate inverted file index in ann.py
+SIMILARITY_BACKEND = os.environ.get('AJAR_SIMILARITY_BACKEND', 'exact')
+
+# Number of IVF lists scanned per query - higher is slower with better recall
+IVF_NPROBE = int(os.environ.get('AJAR_IVF_NPROBE', '8'))
+
+# The IVF index clusters the similarity matrix with dense centroids - one row of 2 ** 20 floats per list over the hashed features (see hashing.py), too large to build or keep in memory
+if FEATURE_SPACE == 'hashing' and SIMILARITY_BACKEND == 'ivf':
+    raise ValueError("AJAR_SIMILARITY_BACKEND 'ivf' cannot be used with AJAR_FEATURE_SPACE 'hashing' - use 'exact', or the 'svd' feature space")
+
+# Springer API fetching - requests per second, largest burst of requests and number of concurrent requests
+FETCH_RATE = float(os.environ.get('AJAR_FETCH_RATE', '1'))
+FETCH_BURST = int(os.environ.get('AJAR_FETCH_BURST', '2'))
+FETCH_WORKERS = int(os.environ.get('AJAR_FETCH_WORKERS', '4'))
+
+# Number of worker processes for the daily collection's text processing pipeline
+PIPELINE_WORKERS = int(os.environ.get('AJAR_PIPELINE_WORKERS', str(os.cpu_count() or 1)))
+
+# Number of worker processes clustering users' favorites in daily_recommendations.py
+RECOMMEND_WORKERS = int(os.environ.get('AJAR_RECOMMEND_WORKERS', '4'))
+
+# Database connection - an ODBC connection string for SQL Server, or sqlite:///<path> for a local SQLite database
+DB_CONNECTION = os.environ.get('AJAR_DB_CONNECTION', 'DRIVER={ODBC Driver 17 for SQL Server};SERVER=ga-cc12-s5.database.windows.net;DATABASE=capstone;UID=[REDACTED];PWD=[REDACTED]')
+
+# Largest number of connections each app process keeps open
+DB_POOL_SIZE = int(os.environ.get('AJAR_DB_POOL_SIZE', '8'))
+
+# Server-side cache of result lists for the results pages - largest number of lists kept per app process, and seconds a list is kept
+RESULT_CACHE_SIZE = int(os.environ.get('AJAR_RESULT_CACHE_SIZE', '1000'))
+RESULT_CACHE_TTL = float(os.environ.get('AJAR_RESULT_CACHE_TTL', '600'))
+
+# Largest number of paper rows (title, abstract, etc.) each app process keeps cached
+PAPER_CACHE_SIZE = int(os.environ.get('AJAR_PAPER_CACHE_SIZE', '50000'))
+
+# Sampling profiler - when on, adding profile=1 to a request URL returns the request's sampled stacks instead of the page. Seconds between samples
+PROFILING = os.environ.get('AJAR_PROFILING', '0') == '1'
+PROFILE_INTERVAL = float(os.environ.get('AJAR_PROFILE_INTERVAL', '0.005'))
+
+# Background recomputation of recommendations after a favorite is toggled - seconds to wait for further toggles before starting, and number of worker threads per app process
+RECOMPUTE_DELAY = float(os.environ.get('AJAR_RECOMPUTE_DELAY', '2'))
+TASK_WORKERS = int(os.environ.get('AJAR_TASK_WORKERS', '2'))
+
+# Redis server (e.g. redis://localhost:6379/0) for sharing background task results between app processes. Empty keeps them in each process's memory
+REDIS_URL = os.environ.get('AJAR_REDIS_URL', '')
+
+# Near-duplicates found by the daily collection (see minhash.py) - 'drop' leaves them out of the archive, 'flag' stores them anyway. Either way they are listed in the run's report
+DUPLICATES = os.environ.get('AJAR_DUPLICATES', 'drop')
+
+# Daily recommendations only score papers of journals whose centroid (see summaries.py) has at least this cosine score against one of the user's favorites/centroids. 0 scores every paper
+JOURNAL_PREFILTER = float(os.environ.get('AJAR_JOURNAL_PREFILTER', '0'))
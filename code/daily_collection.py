@@ -2,110 +2,150 @@
 
 # Import relevant libraries
 
-import pandas as pd
-import requests
-import time
-import pyodbc
-import pickle
+import sys
 import numpy as np
-from scipy import sparse
-from langdetect import detect
 from datetime import date, timedelta
-from nltk.stem.wordnet import WordNetLemmatizer
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-# Load pickled model (tfdif vectorizer) and features from previous papers
-
-wl = WordNetLemmatizer()
-vec = pickle.load(open('../data/vectorizer.csv', 'rb'))
-old_features = sparse.load_npz('../data/features.npz')
-
-
-# Try/except for the language detection - would ocasionally throw error which would halt collection process
-def detect_lang(text):
-    try:
-        return detect(text)
-    except:
-        return 'error'
-
-# Function to remove non-alpha characters and lemmatize all words for a paper's abstract
-def parser(title):
-    
-    '''Removes any non-alphabetical characters, converts to lower case, and lemmatizes each word in a document'''
-    
-    letters = re.sub('[^a-zA-Z]', ' ', title)
-    letters = letters.lower()
-    words = re.split('\s+', letters)
-    words = [wl.lemmatize(x) for x in words]
-    return (' '.join(words))
-
-# Create empty dictionary framework for storing data
-papers = {'title':[], 'abstract':[], 'link':[], 'date':[],
-          'type':[], 'authors':[], 'journal':[]}
-
-# String for yesterday's date
-today = date.today().strftime('%Y-%m-%d')
+import neighbours
+import feature_store
+import embeddings
+import ann
+import config
+import fetcher
+import text_pipeline
+import loader
+import text_index
+import catalog
+import paper_cache
+import db
+import metrics
+import minhash
+import hashing
+import summaries
+
+# Load features from previous papers (the pickled tfdif vectorizer is loaded by the text pipeline workers)
+
+old_features = feature_store.load()
+
+# String for yesterday's date (a different day can be given as an argument to ingest a backfilled day)
 yesterday = (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-
-# Connect to SQL server for data upload
-cnxn = pyodbc.connect('DRIVER={ODBC Driver 17 for SQL Server};SERVER=ga-cc12-s5.database.windows.net;DATABASE=capstone;UID=[REDACTED];PWD=[REDACTED]')
-cursor = cnxn.cursor()
-
-start = True
-x = 0
-
-# This for loop pings the Spring API for papers from the previous day (50 papers per request limit). Loop continues until less than 50 papers are pulled. Data is stored in the dictionary created above
-while start:
-
-    data = requests.get("http://api.springer.com/metadata/json?api_key=4a6226d4feb9e43bf17f2a83b4cce338&q=type:Journal onlinedatefrom:" + yesterday + " onlinedateto:" + today + "&s=" + str(x) + "&p=50")
-    ream = data.json()['records']
-    papers['title'] += [str(z.get('title')) for z in ream]
-    papers['abstract'] += [str(z.get('abstract')) for z in ream]
-    papers['link'] += [str(z.get('url')[0].get('value')) for z in ream]
-    papers['date'] += [str(z.get('publicationDate')) for z in ream]
-    papers['type'] += [str(z.get('contentType')) for z in ream]
-    papers['journal'] += [str(z.get('publicationName')) for z in ream]
-    print(papers['date'][-1])
-    for paper in ream:
-        authors = ''
-        for author in [y.get('creator') for y in paper.get('creators')]:
-            authors += author + ' | '
-        authors = authors[:-3]
-        papers['authors'].append(authors)
-
-    if len(ream) < 50:
-        start = False
-    else:
-        time.sleep(3)
-        x += 50
-
-# Data cleaning
-# Remove duplicates, papers from the incorrect date (API returns papers for the first days of each month for the year for some reason despite date search parameters). Remove papers not in English as well as those with empty or symbol-filled abstracts/titles. Removes redacted/corrected papers (low abstract character count). Assign unique id number to each paper
-
-df = pd.DataFrame.from_dict(papers)
-df.drop_duplicates(subset='title', inplace=True)
-df = df[df['type'] == 'Article']
-df = df[df['date'] == yesterday]
-df = df[['{' not in df['title'][x] and '???' not in df['abstract'][x] for x in df.index]]
-df = df[[detect_lang(df['title'][x]) == 'en' and detect_lang(df['abstract'][x]) == 'en' for x in df.index]]
-df = df[[len(df['abstract'][x]) > 150 for x in df.index]]
-df.sort_values(by=['date', 'title'], inplace=True)
-paper_id = list(cursor.execute("SELECT MAX(id) FROM papers;").fetchall()[0])[0] + 1
-df['p_abstract'] = [parser(x) for x in df['abstract']]        
-df.sort_values(by='title', inplace=True)
+if len(sys.argv) > 1:
+    yesterday = sys.argv[1]
+
+# Every stage below is timed, and the timings are written to ../data/reports/collection_<day>.json at the end (see metrics.StageReport)
+report = metrics.StageReport('collection_' + yesterday)
+
+# Connect to SQL server for data upload (config.DB_CONNECTION)
+cnxn = db.connect()
+
+# Collect every paper from yesterday from the Springer API (50 papers per request limit, pages are fetched concurrently under a rate limit - see fetcher.py)
+# Each page is cleaned, lemmatized and vectorized by the text pipeline's worker processes as soon as it arrives (see text_pipeline.py for the cleaning rules). new_features are the feature rows of the papers in df, which is sorted by title
+# The pipeline stage is wall time of fetching and processing together; the fetch wait and the workers' clean/vectorize times (summed over all workers) are recorded as well
+fetch = fetcher.SpringerFetcher()
+with report.stage('fetch_and_process') as stage:
+    df, new_features, stats = text_pipeline.process(fetch.pages(yesterday), yesterday)
+    stage['items'] = len(df)
+report.add('fetch_wait', stats['fetch_seconds'], stats['records'])
+report.add('clean', stats['clean_seconds'], stats['records'])
+report.add('vectorize', stats['vectorize_seconds'], stats['papers'])
+
+# Find near-duplicates (reposted, corrected or cross-listed papers) among the new papers by the MinHash signatures of their abstracts - of archived papers, or of another new paper earlier in df. The signature store is built from the papers table if it does not cover the archive yet
+# With config.DUPLICATES == 'drop' they are left out of df and new_features, otherwise they are stored as usual; either way each one is listed in the report
+# with the paper id it is stored under (None if dropped) and the paper id of the paper it duplicates (None for a new paper that is dropped itself, which is named by its title)
+with report.stage('duplicates', len(df)) as stage:
+    store = minhash.load(old_features.shape[0]) or minhash.build(cnxn, old_features.shape[0])
+    signatures = minhash.signatures(df['p_abstract'])
+    duplicate_of = minhash.find_duplicates(signatures, store)
+    del store
+    keep = duplicate_of == 0 if config.DUPLICATES == 'drop' else np.ones(len(df), dtype=bool)
+    new_ids = old_features.shape[0] + np.cumsum(keep)
+    duplicates = []
+    for x in np.nonzero(duplicate_of)[0]:
+        entry = {'title': df['title'].iloc[x], 'link': df['link'].iloc[x], 'id': int(new_ids[x]) if keep[x] else None}
+        if duplicate_of[x] > 0:
+            entry['duplicate_of'] = int(duplicate_of[x])
+        else:
+            j = -duplicate_of[x] - 1
+            entry['duplicate_of'] = int(new_ids[j]) if keep[j] else None
+            entry['duplicate_of_title'] = df['title'].iloc[j]
+        duplicates.append(entry)
+        print('Near-duplicate: "' + entry['title'] + '" of ' + ('paper ' + str(entry['duplicate_of']) if entry['duplicate_of'] else '"' + entry['duplicate_of_title'] + '"'))
+    report.detail('duplicates', duplicates)
+    if config.DUPLICATES == 'drop':
+        df = df[keep].reset_index(drop=True)
+        new_features = new_features[np.nonzero(keep)[0]]
+        signatures = signatures[keep]
+    stage['items'] = int(np.count_nonzero(duplicate_of))
+
+# Assign unique id number to each paper - ids follow on from the rows of the feature matrix (checked against the papers table when the papers are inserted)
+paper_id = old_features.shape[0] + 1
 df['id'] = np.arange(paper_id, paper_id + len(df))
 
-
-# Use pickled vectorizer to create features for new papers and concatenate it with the old feature matrix
-new_features = vec.transform(df['p_abstract'])
-all_features = sparse.vstack([old_features, new_features])
-
-sparse.save_npz('../data/features.npz', all_features)
-
-# Insert new papers to the SQL table
-for index, row in df.iterrows():
-    cursor.execute("INSERT INTO papers (title, abstract, link, date, journal, authors, id) values(?,?,?,?,?,?,?)",
-                    row['title'], row['abstract'], row['link'], row['date'], row['journal'], row['authors'], row['id'])
-
-cnxn.commit()
-cursor.close()
\ No newline at end of file
+# all_features is the old feature matrix with the new rows added (without copying the old rows)
+all_features = feature_store.extend(old_features, new_features)
+
+# Project the new papers into the dense embedding store when it is in use
+if config.FEATURE_SPACE == 'svd':
+    with report.stage('embeddings', len(df)):
+        embeddings.update(all_features, old_features.shape[0])
+
+# vectors is the matrix used for similarity with the new papers included. With the hashed feature space the new papers' abstracts are hashed into term counts, and vectors weights the archive's and the new counts by the IDF including the new papers (the hashed store is built from the papers table the first time)
+if config.FEATURE_SPACE == 'hashing':
+    with report.stage('hashing', len(df)):
+        new_counts = hashing.transform(df['p_abstract'])
+        vectors = hashing.update(cnxn, new_counts, old_features.shape[0])
+else:
+    vectors = embeddings.select(all_features)
+
+# Add the new papers to the nearest neighbour table (and let them into the neighbour lists of older papers)
+with report.stage('neighbours', len(df)):
+    neighbours.update(vectors, old_features.shape[0])
+
+# Add the new papers' terms to the inverted index used by the search page
+with report.stage('text_index', len(df)):
+    text_index.update(all_features, old_features.shape[0])
+
+# Add the new papers' signatures to the near-duplicate store
+with report.stage('signatures', len(df)):
+    minhash.update(signatures, old_features.shape[0])
+
+# Add the new papers to the approximate nearest neighbour index when it is in use, and check its recall against exact search on a sample of the new papers
+if config.SIMILARITY_BACKEND == 'ivf':
+    with report.stage('ivf', len(df)):
+        ivf_index = ann.update(vectors, old_features.shape[0])
+    sample = np.arange(old_features.shape[0], all_features.shape[0])[:200]
+    if len(sample) > 0:
+        print('IVF recall@5: ' + str(round(ann.recall_at_k(ivf_index, sample, k=5), 3)))
+
+# Add the new papers' dates and journals to the paper catalog
+with report.stage('catalog', len(df)):
+    catalog.update(cnxn, df, old_features.shape[0])
+
+# Add the new papers to the journal and day centroid sums (see summaries.py)
+with report.stage('summaries', len(df)):
+    summaries.update(vectors, catalog.load(all_features.shape[0]), old_features.shape[0])
+
+# Publish the new papers' features as one new shard (their hashed counts first, when in use - the app only looks at the hashed store once the feature store has the new rows)
+def publish():
+    if config.FEATURE_SPACE == 'hashing':
+        hashing.append(new_counts, yesterday)
+    feature_store.append(new_features, yesterday)
+
+# Insert the new papers to the SQL table and publish their features in a single unit of work, once everything derived from them is in place - the app picks them up on its next request
+# If this fails, the stores above already cover the new rows - the next run's updates drop every row beyond the feature matrix before adding its own
+with report.stage('load', len(df)):
+    loader.load_papers(cnxn, df, publish, old_features.shape[0])
+cnxn.close()
+
+# Have the app processes drop their cached paper rows
+paper_cache.touch()
+
+# Every so often the feature shards are merged back together
+with report.stage('compact'):
+    feature_store.compact()
+    if config.FEATURE_SPACE == 'hashing':
+        hashing.compact()
+
+# The day is stored, so its fetch checkpoints are no longer needed
+fetch.clear(yesterday)
+
+report.write(len(df))
@@ -0,0 +1,87 @@
+# This script is run daily after daily_collection.py to precompute every user's recommendations for the new papers, so logging in does not have to cluster and score favorites
+
+# Import relevant libraries
+
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from similarity import SimilarityEngine
+import neighbours
+import catalog
+import summaries
+import feature_store
+import recommend
+import embeddings
+import ann
+import config
+import db
+
+"""
+Results are written to the user_recs table (use_id, date, p_id, score), one row per recommended paper.
+Users with favorites but no paper above the threshold get a single row with p_id = 0 so the app knows the job ran for them.
+The table only keeps the latest day - user_home reads it on login and the app deletes a user's rows when they change their favorites.
+"""
+
+# Load features and the neighbour table (also loaded by each worker process)
+
+features = embeddings.select(feature_store.load())
+engine = SimilarityEngine(features)
+if config.SIMILARITY_BACKEND == 'ivf':
+    engine = ann.load(engine) or engine
+neighbour_ids, neighbour_scores = neighbours.load(features.shape[0])
+
+# Same behaviour as get_matches in app.py - papers similar to a paper, from the neighbour table when possible
+def get_matches(pid, num=5):
+    row = int(pid) - 1
+    stored = neighbours.lookup(neighbour_ids, neighbour_scores, row, num, 0.3)
+    if stored is not None:
+        return [x + 1 for x in stored]
+    rows, scores = engine.top_k(features[row], k=num, threshold=0.3, exclude=[[row]])[0]
+    return [int(x) + 1 for x in rows]
+
+# Clustering step for one user, run in the process pool (updates the user's cached clusters)
+def centroids(user, fav_ids):
+    return recommend.user_centroids(features, fav_ids, get_matches, user=user)
+
+
+if __name__ == '__main__':
+
+    yesterday = (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    # Connect to SQL server (config.DB_CONNECTION)
+    cnxn = db.connect()
+    cursor = cnxn.cursor()
+
+    # Id ranges of yesterday's papers - one block of ids (and feature rows), or a few if the day was ingested more than once
+    rec_ids = catalog.id_ranges_of([x[0] for x in db.query(cnxn, 'day_ids', (yesterday,))])
+
+    # Favorites of every user {user id: [paper ids]}
+    favs = {}
+    for use_id, p_id in db.query(cnxn, 'all_favorites'):
+        favs.setdefault(use_id, []).append(int(p_id))
+    users = sorted(favs)
+
+    db.ensure_schema(cnxn)
+    cursor.execute(db.QUERIES['clear_all_user_recs'])
+
+    if len(rec_ids) > 0 and len(users) > 0:
+        # Cluster each user's favorites in parallel, then score every user's centroids against yesterday's papers in one batch
+        with ProcessPoolExecutor(max_workers=config.RECOMMEND_WORKERS) as pool:
+            user_centroids = list(pool.map(centroids, users, [favs[x] for x in users], chunksize=16))
+        # With config.JOURNAL_PREFILTER, only papers of journals close to a user's centroids are scored for them (needs the paper catalog and the journal summaries)
+        journals = None
+        paper_catalog, paper_summaries = catalog.load(features.shape[0]), summaries.load(features.shape[0], features.shape[1])
+        if config.JOURNAL_PREFILTER > 0 and paper_catalog is not None and paper_summaries is not None:
+            journals = (paper_catalog.codes, paper_summaries.journal_unit)
+        results = recommend.batch_daily_matches(engine, user_centroids, [favs[x] for x in users], rec_ids, journals=journals, prefilter=config.JOURNAL_PREFILTER)
+
+        rows = []
+        for user, (ids, scores) in zip(users, results):
+            if len(ids) == 0:
+                rows.append((user, yesterday, 0, 0.0))
+            rows += [(user, yesterday, int(x), float(y)) for x, y in zip(ids, scores)]
+        if not db.is_sqlite(cnxn):
+            cursor.fast_executemany = True
+        cursor.executemany(db.QUERIES['add_user_rec'], rows)
+
+    cnxn.commit()
+    cursor.close()
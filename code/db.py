@@ -0,0 +1,185 @@
+# Database access layer - connection pool, per-request connections for the Flask app and the parameterized queries the application uses
+
+# Import relevant libraries
+
+import time
+import queue
+import sqlite3
+import threading
+from flask import g
+import config
+
+"""
+Connections come from config.DB_CONNECTION: an ODBC connection string for SQL Server (pyodbc), or sqlite:///<path> for a
+local SQLite database (used for testing and benchmarks - the SQL below runs on both).
+The app checks a connection out of a bounded pool the first time a request needs one (get_db) and hands it back when the
+request ends (teardown). A connection that has been idle for more than CHECK_AFTER seconds, or that was in use when a
+request failed, is health checked with SELECT 1 and replaced if the check fails, so a dropped connection costs one
+reconnect instead of the worker.
+Every query is parameterized. The fixed ones live in QUERIES so the same statement text is sent every time and the
+server can reuse its prepared plan.
+Tables the app and the daily scripts create themselves (TABLES - user_recs, filled by daily_recommendations.py) are
+created when the app starts if they do not exist yet, so the app works before the nightly job has ever run.
+"""
+
+CHECK_AFTER = 30
+
+QUERIES = {
+    'user_count': "SELECT COUNT(name) FROM users WHERE name = ?",
+    'user': "SELECT * FROM users WHERE name = ?",
+    'max_user_id': "SELECT MAX(id) FROM users",
+    'add_user': "INSERT INTO users (id, name, pass) values (?,?,?)",
+    'favorites': "SELECT p_id FROM favs WHERE use_id = ?",
+    'add_favorite': "INSERT INTO favs (use_id, p_id, title, journal) values (?,?,?,?)",
+    'remove_favorite': "DELETE FROM favs WHERE p_id = ? AND use_id = ?",
+    'all_favorites': "SELECT use_id, p_id FROM favs",
+    'day_count': "SELECT COUNT(*) FROM papers WHERE date = ?",
+    'day_ids': "SELECT id FROM papers WHERE date = ? ORDER BY id",
+    'journal_papers': "SELECT id FROM papers WHERE journal = ? ORDER BY id DESC",
+    'user_recs': "SELECT p_id FROM user_recs WHERE use_id = ? AND date = ? ORDER BY score DESC",
+    'clear_user_recs': "DELETE FROM user_recs WHERE use_id = ?",
+    'clear_all_user_recs': "DELETE FROM user_recs",
+    'add_user_rec': "INSERT INTO user_recs (use_id, date, p_id, score) values (?,?,?,?)",
+}
+
+TABLES = {
+    'user_recs': "use_id INT NOT NULL, date VARCHAR(10) NOT NULL, p_id INT NOT NULL, score FLOAT NOT NULL",
+}
+
+# Whether a connection is a local SQLite stand-in rather than pyodbc
+def is_sqlite(cnxn):
+    return type(cnxn).__module__.startswith('sqlite3')
+
+# Open a new connection according to config.DB_CONNECTION
+def connect(connection=None):
+    connection = connection or config.DB_CONNECTION
+    if connection.startswith('sqlite:///'):
+        return sqlite3.connect(connection[len('sqlite:///'):], check_same_thread=False)
+    import pyodbc
+    return pyodbc.connect(connection)
+
+# Run a query (a QUERIES name or SQL text) with parameters on a connection and return all rows
+def query(cnxn, sql, params=()):
+    cursor = cnxn.cursor()
+    try:
+        return cursor.execute(QUERIES.get(sql, sql), tuple(params)).fetchall()
+    finally:
+        cursor.close()
+
+# Run a statement (a QUERIES name or SQL text) with parameters on a connection, without committing
+def execute(cnxn, sql, params=()):
+    cursor = cnxn.cursor()
+    try:
+        cursor.execute(QUERIES.get(sql, sql), tuple(params))
+    finally:
+        cursor.close()
+
+# Create the tables in TABLES that do not exist yet, and commit
+def ensure_schema(cnxn):
+    for name, columns in TABLES.items():
+        if is_sqlite(cnxn):
+            execute(cnxn, "CREATE TABLE IF NOT EXISTS " + name + " (" + columns + ")")
+        else:
+            execute(cnxn, "IF OBJECT_ID('" + name + "', 'U') IS NULL CREATE TABLE " + name + " (" + columns + ")")
+    cnxn.commit()
+
+# Whether a connection still answers
+def healthy(cnxn):
+    try:
+        query(cnxn, "SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+# Bounded pool of connections. acquire() blocks for up to timeout seconds when all size connections are checked out
+class ConnectionPool:
+
+    def __init__(self, connector=connect, size=None, timeout=30):
+        self.connector = connector
+        self.size = size or config.DB_POOL_SIZE
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    # Check out a connection - an idle one if there is one, a new one while the pool is below size, otherwise wait for one to be released
+    def acquire(self):
+        try:
+            cnxn, last_used = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                grow = self.created < self.size
+                if grow:
+                    self.created += 1
+            if grow:
+                try:
+                    return self.connector()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            cnxn, last_used = self.idle.get(timeout=self.timeout)
+        if time.monotonic() - last_used > CHECK_AFTER and not healthy(cnxn):
+            try:
+                cnxn = self.replace(cnxn)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return cnxn
+
+    # Give a connection back. Uncommitted work is rolled back; after a failed request the connection is checked and replaced if it is broken
+    def release(self, cnxn, failed=False):
+        try:
+            cnxn.rollback()
+        except Exception:
+            failed = True
+        if failed and not healthy(cnxn):
+            try:
+                cnxn = self.replace(cnxn)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                return
+        self.idle.put((cnxn, time.monotonic()))
+
+    # Close a broken connection and open a new one in its place
+    def replace(self, cnxn):
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+        return self.connector()
+
+
+pool = None
+
+# Set up the pool for a Flask app (connector defaults to connect, e.g. lambda: sqlite3.connect(...) for tests), create any missing tables and return connections at the end of every request
+# If the database cannot be reached at start up the tables are left for the next start (or the nightly job) to create
+def init_app(app, connector=None, size=None):
+    global pool
+    pool = ConnectionPool(connector or connect, size)
+    app.teardown_appcontext(teardown)
+    try:
+        cnxn = pool.acquire()
+    except Exception as e:
+        print('Could not connect to the database to check its tables: ' + str(e))
+        return
+    try:
+        ensure_schema(cnxn)
+        pool.release(cnxn)
+    except Exception as e:
+        print('Could not create the missing tables: ' + str(e))
+        pool.release(cnxn, failed=True)
+
+# The current request's connection, checked out of the pool on first use
+def get_db():
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+def teardown(exception):
+    cnxn = g.pop('db', None)
+    if cnxn is not None:
+        pool.release(cnxn, failed=exception is not None)
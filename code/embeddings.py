@@ -0,0 +1,76 @@
+# Dense embedding store - TruncatedSVD (LSA) projection of the TF-IDF features, saved as a float32 .npy file that is memory-mapped by the app
+
+# Import relevant libraries
+
+import os
+import pickle
+import numpy as np
+from numpy.lib.format import open_memmap
+from sklearn.decomposition import TruncatedSVD
+import config
+import hashing
+
+"""
+The SVD model is fit once on the archive and pickled (like the vectorizer), and every day only the new rows are projected
+and appended. Embeddings are stored L2 normalized, so cosine similarity is a plain float32 dot product and the whole
+file can be shared between processes through np.load(mmap_mode='r') without being copied.
+Used in place of the TF-IDF features when config.FEATURE_SPACE is 'svd'. select() also picks the hashed features (see
+hashing.py) when config.FEATURE_SPACE is 'hashing'.
+"""
+
+SVD_PATH = '../data/svd.pkl'
+EMBEDDINGS_PATH = '../data/embeddings.npy'
+CHUNK = 50000
+
+# Load the embeddings of the first n_rows papers as a read only memory map. Returns None if there are none or they cover fewer rows. They cover more while (or after) daily_collection.py fails to publish the papers they were computed for - those rows are left out
+def load(n_rows=None, path=EMBEDDINGS_PATH):
+    if not os.path.exists(path):
+        return None
+    emb = np.load(path, mmap_mode='r')
+    if n_rows is None:
+        return emb
+    return emb[:n_rows] if emb.shape[0] >= n_rows else None
+
+# Matrix used for similarity and clustering - the embeddings, the hashed features or the TF-IDF features, depending on config.FEATURE_SPACE
+# The embeddings and hashed features have to cover every row of features - until daily_collection.py has built them the TF-IDF features are used
+def select(features, path=EMBEDDINGS_PATH):
+    if config.FEATURE_SPACE == 'svd':
+        emb = load(features.shape[0], path)
+        if emb is not None:
+            return emb
+        print('Embeddings do not cover the feature store yet, using the TF-IDF features')
+    if config.FEATURE_SPACE == 'hashing':
+        hashed = hashing.load(features.shape[0])
+        if hashed is not None:
+            return hashed
+        print('Hashed features do not cover the feature store yet, using the TF-IDF features')
+    return features
+
+# Project feature rows with the SVD model, returning unit length float32 rows
+def transform(svd, features):
+    emb = svd.transform(features).astype(np.float32)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return emb / norms
+
+# Add embeddings for feature rows n_old: to the store. The model is fit (and every row projected) if there is no model yet or the stored embeddings cover fewer than n_old rows (rows beyond n_old, from a run whose load failed, are dropped)
+# The new file is written next to the old one and swapped in with os.replace, so processes that have the old file mapped keep a consistent copy
+def update(features, n_old, svd_path=SVD_PATH, path=EMBEDDINGS_PATH, dims=None):
+    n = features.shape[0]
+    old = load(None, path)
+    if os.path.exists(svd_path) and old is not None and old.shape[0] >= n_old:
+        svd = pickle.load(open(svd_path, 'rb'))
+    else:
+        svd = TruncatedSVD(n_components=dims or config.SVD_DIMENSIONS, random_state=0).fit(features.tocsr())
+        pickle.dump(svd, open(svd_path, 'wb'))
+        n_old = 0
+
+    emb = open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=(n, svd.n_components))
+    if n_old > 0:
+        emb[:n_old] = old[:n_old]
+    for start in range(n_old, n, CHUNK):
+        stop = min(start + CHUNK, n)
+        emb[start:stop] = transform(svd, features[start:stop])
+    emb.flush()
+    del emb, old
+    os.replace(path + '.tmp', path)
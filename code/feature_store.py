@@ -0,0 +1,161 @@
+# Feature store - the TF-IDF feature matrix saved as append-only shards of raw CSR arrays that every process memory-maps instead of loading its own copy of features.npz
+
+# Import relevant libraries
+
+import os
+import json
+import shutil
+import numpy as np
+from scipy import sparse
+from similarity import row_norms
+
+"""
+Layout of the store (../data/features):
+shards/<name>/ = one immutable shard per ingestion day, holding data.npy, indices.npy, indptr.npy and shape.npy of the
+                 day's CSR rows plus norms.npy (row norms for the similarity engine)
+manifest.json = {"version": n, "shards": [{"name": ..., "rows": ...}, ...]} - the shards making up the live matrix, in row (paper id) order
+The nightly job only writes a shard for the new papers and then atomically replaces the manifest, so the daily write is
+O(new papers), a crash mid-write leaves the previous manifest (and every shard it lists) untouched, and readers see
+either the old or the new matrix. Once there are more than COMPACT_AT shards, compact() merges them into one.
+The arrays are uncompressed and opened with np.load(mmap_mode='r'), so all app workers share one copy in the page cache.
+load() returns a single logical matrix whose rows are paper id - 1 (a plain csr_matrix when there is only one shard).
+The app checks version() before each request and reloads when the nightly job has published a new manifest.
+"""
+
+STORE_DIR = '../data/features'
+LEGACY_PATH = '../data/features.npz'
+COMPACT_AT = 32
+
+
+# Read only view of several CSR shards stacked on top of each other. Supports the operations the rest of the code uses on the feature matrix: shape, row selection (int, slice or id array - returns a csr_matrix) and matrix products
+class ShardedMatrix:
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.concatenate([[0], np.cumsum([x.shape[0] for x in shards])])
+        self.shape = (int(self.offsets[-1]), shards[0].shape[1])
+        self.dtype = shards[0].dtype
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            rows = rows + self.shape[0] if rows < 0 else rows
+            at = int(np.searchsorted(self.offsets, rows, side='right')) - 1
+            return self.shards[at][rows - self.offsets[at]]
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+        rows = np.asarray(rows, dtype=np.int64)
+        at = np.searchsorted(self.offsets, rows, side='right') - 1
+        order = np.argsort(at, kind='stable')
+        parts = [self.shards[x][rows[order][at[order] == x] - self.offsets[x]] for x in np.unique(at)]
+        if len(parts) == 0:
+            return sparse.csr_matrix((0, self.shape[1]), dtype=self.dtype)
+        stacked = sparse.vstack(parts, format='csr')
+        if np.all(order[1:] > order[:-1]):
+            return stacked
+        return stacked[np.argsort(order)]
+
+    def __matmul__(self, other):
+        parts = [x @ other for x in self.shards]
+        if sparse.issparse(parts[0]):
+            return sparse.vstack(parts, format='csr')
+        return np.vstack(parts) if np.ndim(parts[0]) > 1 else np.concatenate(parts)
+
+    def tocsr(self):
+        return sparse.vstack(self.shards, format='csr')
+
+
+# Function which reads the manifest, None if nothing has been published yet
+def read_manifest(store_dir=STORE_DIR):
+    path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Atomically replace the manifest
+def write_manifest(manifest, store_dir=STORE_DIR):
+    path = os.path.join(store_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+# Version number of the live manifest, None if nothing has been published yet
+def version(store_dir=STORE_DIR):
+    manifest = read_manifest(store_dir)
+    return None if manifest is None else manifest['version']
+
+# Write a matrix as an (unpublished) shard directory. Returns the shard entry for the manifest
+def write_shard(matrix, name, store_dir=STORE_DIR):
+    matrix = sparse.csr_matrix(matrix)
+    path = os.path.join(store_dir, 'shards', name)
+    if os.path.exists(path + '.tmp'):
+        shutil.rmtree(path + '.tmp')
+    os.makedirs(path + '.tmp')
+    for key, value in [('data', matrix.data), ('indices', matrix.indices), ('indptr', matrix.indptr),
+                       ('shape', np.array(matrix.shape)), ('norms', row_norms(matrix))]:
+        np.save(os.path.join(path + '.tmp', key + '.npy'), value)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(path + '.tmp', path)
+    return {'name': name, 'rows': int(matrix.shape[0])}
+
+# Function which opens one shard as a csr_matrix over memory-mapped arrays
+def read_shard(name, store_dir=STORE_DIR):
+    path = os.path.join(store_dir, 'shards', name)
+    arrays = {x: np.load(os.path.join(path, x + '.npy'), mmap_mode='r') for x in ['data', 'indices', 'indptr']}
+    shape = tuple(int(x) for x in np.load(os.path.join(path, 'shape.npy')))
+    return sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+# Add rows to the end of the matrix as a new shard (named after the ingestion day) and publish it
+def append(matrix, name, store_dir=STORE_DIR):
+    manifest = read_manifest(store_dir) or {'version': 0, 'shards': []}
+    names = [x['name'] for x in manifest['shards']]
+    while name in names:
+        name += '_'
+    entry = write_shard(matrix, name, store_dir)
+    write_manifest({'version': manifest['version'] + 1, 'shards': manifest['shards'] + [entry]}, store_dir)
+
+# Merge every shard into one once there are more than max_shards of them, then remove the shard directories the manifest no longer lists (processes that still have them mapped keep their copy until they reload)
+def compact(store_dir=STORE_DIR, max_shards=COMPACT_AT):
+    manifest = read_manifest(store_dir)
+    if manifest is None or len(manifest['shards']) <= max_shards:
+        return
+    merged = sparse.vstack([read_shard(x['name'], store_dir) for x in manifest['shards']], format='csr')
+    entry = write_shard(merged, 'compacted_' + str(manifest['version'] + 1), store_dir)
+    write_manifest({'version': manifest['version'] + 1, 'shards': [entry]}, store_dir)
+    for name in os.listdir(os.path.join(store_dir, 'shards')):
+        if name != entry['name']:
+            shutil.rmtree(os.path.join(store_dir, 'shards', name), ignore_errors=True)
+
+# Logical matrix of the stored rows followed by new rows that have not been published yet
+def extend(matrix, rows):
+    shards = list(matrix.shards) if isinstance(matrix, ShardedMatrix) else [matrix]
+    return ShardedMatrix(shards + [sparse.csr_matrix(rows)])
+
+# Create the store the first time it is used - from a single version directory of the previous layout (current symlink) if there is one, otherwise from the old features.npz file
+def bootstrap(store_dir=STORE_DIR):
+    if read_manifest(store_dir) is not None:
+        return
+    link = os.path.join(store_dir, 'current')
+    if os.path.islink(link):
+        os.makedirs(os.path.join(store_dir, 'shards'), exist_ok=True)
+        os.rename(os.path.realpath(link), os.path.join(store_dir, 'shards', 'base'))
+        write_manifest({'version': 1, 'shards': [{'name': 'base', 'rows': read_shard('base', store_dir).shape[0]}]}, store_dir)
+        os.remove(link)
+    else:
+        append(sparse.load_npz(LEGACY_PATH), 'base', store_dir)
+
+# Open the live matrix (all shards as one logical matrix, rows = paper id - 1)
+def load(store_dir=STORE_DIR, manifest=None):
+    bootstrap(store_dir)
+    manifest = manifest or read_manifest(store_dir)
+    shards = [read_shard(x['name'], store_dir) for x in manifest['shards']]
+    return shards[0] if len(shards) == 1 else ShardedMatrix(shards)
+
+# Precomputed row norms of the live matrix
+def load_norms(store_dir=STORE_DIR, manifest=None):
+    manifest = manifest or read_manifest(store_dir)
+    norms = [np.load(os.path.join(store_dir, 'shards', x['name'], 'norms.npy'), mmap_mode='r') for x in manifest['shards']]
+    return norms[0] if len(norms) == 1 else np.concatenate(norms)
@@ -0,0 +1,155 @@
+# Springer API fetcher - downloads a day's records in parallel under a rate limit, with retries and a checkpoint of every completed page
+
+# Import relevant libraries
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import config
+
+"""
+The first page of a day tells us the total number of records, after which the remaining pages are requested
+concurrently through one pooled requests.Session. Every request first takes a token from a token bucket
+(config.FETCH_RATE requests per second, bursts of up to config.FETCH_BURST), and failed requests (connection errors,
+429 and 5xx responses) are retried with exponential backoff.
+Every completed page is saved to ../data/fetch/<day>/<offset>.json, so a run that is interrupted resumes from the pages
+it already has, and pages fetched ahead of time (backfill) are picked up by daily_collection.py.
+base_url can point at a local server serving recorded Springer JSON for testing.
+"""
+
+API_URL = 'http://api.springer.com/metadata/json'
+API_KEY = '4a6226d4feb9e43bf17f2a83b4cce338'
+PAGE = 50
+CHECKPOINT_DIR = '../data/fetch'
+
+
+# Token bucket rate limiter shared by the fetching threads
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a token is available, then take it
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SpringerFetcher:
+
+    def __init__(self, base_url=API_URL, api_key=API_KEY, rate=None, burst=None, workers=None, retries=5, backoff=1.0,
+                 checkpoint_dir=CHECKPOINT_DIR, timeout=30):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.bucket = TokenBucket(rate or config.FETCH_RATE, burst or config.FETCH_BURST)
+        self.workers = workers or config.FETCH_WORKERS
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint_dir = checkpoint_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+
+    # One API request, retried with exponential backoff (plus jitter) on connection errors, 429 and 5xx responses
+    def get(self, params):
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(str(response.status_code) + ' response from ' + self.base_url)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+        raise error
+
+    # Checkpoint file of one page of a day
+    def checkpoint(self, day, start):
+        return os.path.join(self.checkpoint_dir, day, str(start) + '.json')
+
+    # One page of records published on day, starting at record number start. Returns (records, total records for the day - None if the API did not say)
+    def page(self, day, start):
+        path = self.checkpoint(day, start)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            return saved['records'], saved['total']
+        following = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        data = self.get({'api_key': self.api_key, 'q': 'type:Journal onlinedatefrom:' + day + ' onlinedateto:' + following, 's': start, 'p': PAGE})
+        records = data.get('records', [])
+        try:
+            total = int(data['result'][0]['total'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            total = None
+
+        # Save the page (write then rename, so a killed run never leaves a truncated checkpoint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'records': records, 'total': total}, f)
+        os.replace(path + '.tmp', path)
+        return records, total
+
+    # Generator of the record lists of every page for a day, yielded as the pages complete (not in page order)
+    # When the API reports the total the remaining pages are fetched concurrently, otherwise pages are fetched in sequence until one has less than 50 records
+    def pages(self, day):
+        records, total = self.page(day, 0)
+        yield records
+        if total is None:
+            start = 0
+            while len(records) == PAGE:
+                start += PAGE
+                records, _ = self.page(day, start)
+                yield records
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.page, day, start) for start in range(PAGE, total, PAGE)]
+            for future in as_completed(futures):
+                yield future.result()[0]
+
+    # All records for a day
+    def fetch(self, day):
+        return [record for records in self.pages(day) for record in records]
+
+    # Fetch (and checkpoint) every day from first to last, inclusive. Days that are already checkpointed cost no requests
+    def backfill(self, first, last):
+        day = datetime.strptime(first, '%Y-%m-%d')
+        while day <= datetime.strptime(last, '%Y-%m-%d'):
+            records = self.fetch(day.strftime('%Y-%m-%d'))
+            print(day.strftime('%Y-%m-%d') + ': ' + str(len(records)) + ' records')
+            day += timedelta(days=1)
+
+    # Remove a day's checkpoints once its papers have been stored
+    def clear(self, day):
+        path = os.path.join(self.checkpoint_dir, day)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            os.rmdir(path)
+
+
+# Backfill a date range ahead of ingestion: python fetcher.py <first day> <last day> (YYYY-MM-DD)
+if __name__ == '__main__':
+    SpringerFetcher().backfill(sys.argv[1], sys.argv[2])
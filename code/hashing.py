@@ -0,0 +1,167 @@
+# Hashed feature space - raw term counts from stateless feature hashing, weighted at query time by IDF weights that every daily collection refreshes, so terms coined after the vectorizer was fit are not invisible to similarity
+
+# Import relevant libraries
+
+import os
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+import feature_store
+import text_pipeline
+
+"""
+The pickled TF-IDF vectorizer has a vocabulary frozen at the papers it was fit on. Here each (parsed) abstract is
+hashed into N_FEATURES columns instead - no fitting, so the vectorizer never goes stale - and only raw term counts are
+stored. The IDF of every column is worked out from the document frequencies of the stored papers, and applied when the
+matrix is read (HashedFeatures), so adding papers only ever appends counts and updates the frequencies - nothing is
+re-vectorized. Terms in more than MAX_DF of the papers get no weight, as with the vectorizer's max_df. The lower
+cut-off is deliberately far below the vectorizer's min_df of 50 (and there is no max_features limit): a term only has
+to be in MIN_DF papers to count, so a newly coined term carries weight from its second paper on instead of after months.
+The counts are a second feature store (same shard and manifest layout as ../data/features, see feature_store.py) in
+../data/hashed, with the document frequencies of each shard cached in doc_freq/<shard>.npy. daily_collection.py builds
+it from the papers table the first time and then publishes one shard a day together with the TF-IDF features.
+Used in place of the TF-IDF features when config.FEATURE_SPACE is 'hashing', with the exact similarity backend only - IVF
+centroids over N_FEATURES columns would be dense, so config.py refuses the combination.
+"""
+
+HASHED_DIR = '../data/hashed'
+N_FEATURES = 2 ** 20
+MIN_DF = 2
+MAX_DF = 0.95
+BATCH = 10000
+
+
+# Stateless vectorizer - the TF-IDF vectorizer's tokens and stop words, raw counts
+def vectorizer():
+    return HashingVectorizer(n_features=N_FEATURES, stop_words='english', alternate_sign=False, norm=None, dtype=np.float32)
+
+# Raw term counts of parsed abstracts, one row each
+def transform(texts):
+    texts = list(texts)
+    if len(texts) == 0:
+        return sparse.csr_matrix((0, N_FEATURES), dtype=np.float32)
+    return vectorizer().transform(texts)
+
+# Smoothed IDF weights (as the TF-IDF vectorizer computes them) from document frequencies of n_docs papers, 0 for terms outside the MIN_DF/MAX_DF cut-offs
+def idf(doc_freq, n_docs):
+    weights = (np.log((1 + n_docs) / (1 + doc_freq)) + 1).astype(np.float32)
+    weights[(doc_freq < MIN_DF) | (doc_freq > MAX_DF * n_docs)] = 0
+    return weights
+
+
+# Hashed counts weighted by the current IDF. Supports the operations the rest of the code uses on the feature matrix: shape, row selection (returns a csr_matrix) and matrix products
+class HashedFeatures:
+
+    def __init__(self, counts, doc_freq):
+        self.counts = counts
+        self.doc_freq = doc_freq
+        self.idf = idf(doc_freq, counts.shape[0])
+        self.weights = sparse.diags(self.idf)
+        self.shape = counts.shape
+        self.dtype = counts.dtype
+
+    def __getitem__(self, rows):
+        return sparse.csr_matrix(self.counts[rows]) @ self.weights
+
+    def __matmul__(self, other):
+        return self.counts @ (self.weights @ other)
+
+    # L2 norm of every weighted row (1 for empty rows, see similarity.row_norms)
+    def row_norms(self):
+        shards = self.counts.shards if hasattr(self.counts, 'shards') else [self.counts]
+        squares = self.idf.astype(np.float64) ** 2
+        norms = np.sqrt(np.concatenate([x.multiply(x) @ squares for x in shards]))
+        norms[norms == 0] = 1
+        return norms
+
+    def tocsr(self):
+        return self.counts.tocsr() @ self.weights
+
+
+# Shards of a manifest making up its first n_rows rows, None if no run of leading shards adds up to n_rows
+def covering(manifest, n_rows):
+    shards, total = [], 0
+    for x in manifest['shards']:
+        if total >= n_rows:
+            break
+        shards.append(x)
+        total += x['rows']
+    return shards if total == n_rows else None
+
+# Document frequency of every column in a shard - counted from its column indices the first time and cached
+def shard_doc_freq(name, store_dir=HASHED_DIR):
+    path = os.path.join(store_dir, 'doc_freq', name + '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+    counts = np.bincount(feature_store.read_shard(name, store_dir).indices, minlength=N_FEATURES).astype(np.int64)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, counts)
+    os.replace(path + '.tmp', path)
+    return counts
+
+# Remove cached document frequencies of shards the manifest no longer lists (merged, or written by a failed run - their names can be used again)
+def prune(store_dir=HASHED_DIR):
+    manifest = feature_store.read_manifest(store_dir)
+    path = os.path.join(store_dir, 'doc_freq')
+    if manifest is None or not os.path.isdir(path):
+        return
+    names = set(x['name'] + '.npy' for x in manifest['shards'])
+    for name in os.listdir(path):
+        if name not in names:
+            os.remove(os.path.join(path, name))
+
+# Open the hashed features of the first n_rows papers (rows = paper id - 1), weighted by their IDF. Returns None if the store does not cover them - not built yet, or behind the feature store
+def load(n_rows, store_dir=HASHED_DIR):
+    manifest = feature_store.read_manifest(store_dir)
+    shards = None if manifest is None else covering(manifest, n_rows)
+    if not shards:
+        return None
+    counts = [feature_store.read_shard(x['name'], store_dir) for x in shards]
+    doc_freq = sum(shard_doc_freq(x['name'], store_dir) for x in shards)
+    return HashedFeatures(counts[0] if len(counts) == 1 else feature_store.ShardedMatrix(counts), doc_freq)
+
+# Hash the abstracts of the first n_rows papers in the papers table (parsed like the text pipeline does, in batches of batch papers) and publish them as the only shard of the store
+def build(cnxn, n_rows, store_dir=HASHED_DIR, batch=BATCH):
+    cursor = cnxn.cursor()
+    cursor.execute("SELECT id, abstract FROM papers WHERE id <= ? ORDER BY id", (n_rows,))
+    parts, n = [], 0
+    while True:
+        rows = cursor.fetchmany(batch)
+        if len(rows) == 0:
+            break
+        if rows[-1][0] != n + len(rows):
+            raise RuntimeError('paper ids are not consecutive, cannot build the hashed features')
+        parts.append(transform([text_pipeline.parser(x[1]) for x in rows]))
+        n += len(rows)
+    cursor.close()
+    if n != n_rows:
+        raise RuntimeError('the papers table has ' + str(n) + ' of the ' + str(n_rows) + ' archived papers')
+    manifest = feature_store.read_manifest(store_dir) or {'version': 0, 'shards': []}
+    name = 'base_' + str(manifest['version'] + 1)
+    entry = feature_store.write_shard(sparse.vstack(parts, format='csr'), name, store_dir)
+    feature_store.write_manifest({'version': manifest['version'] + 1, 'shards': [entry]}, store_dir)
+    prune(store_dir)
+
+# Hashed features of the n_old archived papers followed by the new papers' counts (not published yet), weighted by the IDF including the new papers
+# The store is built first if it does not cover the archive, and shards a failed run published beyond the archive are dropped from it
+def update(cnxn, counts, n_old, store_dir=HASHED_DIR):
+    manifest = feature_store.read_manifest(store_dir)
+    shards = None if manifest is None else covering(manifest, n_old)
+    if not shards:
+        build(cnxn, n_old, store_dir)
+    elif len(shards) < len(manifest['shards']):
+        feature_store.write_manifest({'version': manifest['version'] + 1, 'shards': shards}, store_dir)
+    old = load(n_old, store_dir)
+    counts = sparse.csr_matrix(counts)
+    return HashedFeatures(feature_store.extend(old.counts, counts), old.doc_freq + np.bincount(counts.indices, minlength=N_FEATURES))
+
+# Publish the new papers' counts as one shard named after the ingestion day (run together with the feature store's append, see loader.load_papers)
+def append(counts, name, store_dir=HASHED_DIR):
+    prune(store_dir)
+    feature_store.append(counts, name, store_dir)
+
+# Merge the shards together like the feature store does
+def compact(store_dir=HASHED_DIR):
+    feature_store.compact(store_dir)
+    prune(store_dir)
@@ -0,0 +1,52 @@
+# Bulk loader for the daily collection - inserts a day's papers and publishes their features as one unit
+
+# Import relevant libraries
+
+import feature_store
+from db import is_sqlite
+
+"""
+Paper ids and feature matrix rows are synced (id = row + 1), so the new papers' ids are fixed by the size of the feature
+matrix they were appended to. load_papers checks that under a lock on the papers table (UPDLOCK/HOLDLOCK on SQL Server,
+BEGIN IMMEDIATE on SQLite) before inserting, so two runs can never hand out the same ids.
+All rows go in with one parameterized executemany (fast_executemany on pyodbc). The features are published after the
+inserts and before the commit; if anything fails the transaction is rolled back and the previous list of feature shards
+is restored, so the table and the feature store are never out of step.
+SQLite connections are supported as a local stand-in for SQL Server.
+"""
+
+INSERT = "INSERT INTO papers (title, abstract, link, date, journal, authors, id) values (?,?,?,?,?,?,?)"
+
+# Start the transaction and return the current highest paper id, holding a lock on the papers table until commit/rollback
+def lock_max_id(cnxn, cursor):
+    if is_sqlite(cnxn):
+        if cnxn.in_transaction:
+            cnxn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        return cursor.execute("SELECT COALESCE(MAX(id), 0) FROM papers").fetchone()[0]
+    return cursor.execute("SELECT ISNULL(MAX(id), 0) FROM papers WITH (UPDLOCK, HOLDLOCK)").fetchone()[0]
+
+# Insert the papers in df (ids already assigned as n_old + 1 onwards) and run publish() (e.g. appending the feature shard) in the same unit of work
+def load_papers(cnxn, df, publish, n_old, store_dir=feature_store.STORE_DIR):
+    cursor = cnxn.cursor()
+    previous = feature_store.read_manifest(store_dir)
+    try:
+        max_id = lock_max_id(cnxn, cursor)
+        if max_id != n_old:
+            raise RuntimeError('papers table (max id ' + str(max_id) + ') and feature matrix (' + str(n_old) + ' rows) are out of step')
+        rows = [(r.title, r.abstract, r.link, r.date, r.journal, r.authors, int(r.id)) for r in df.itertuples()]
+        if not is_sqlite(cnxn):
+            cursor.fast_executemany = True
+        if len(rows) > 0:
+            cursor.executemany(INSERT, rows)
+        publish()
+        cnxn.commit()
+    except:
+        cnxn.rollback()
+        # Put the previous shard list back under a new version number, so readers that loaded the failed version reload
+        current = feature_store.read_manifest(store_dir)
+        if previous is not None and current != previous:
+            feature_store.write_manifest({'version': current['version'] + 1, 'shards': previous['shards']}, store_dir)
+        raise
+    finally:
+        cursor.close()
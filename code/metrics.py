@@ -0,0 +1,214 @@
+# Instrumentation - latency histograms for the app's routes and hot functions (served at /metrics in the Prometheus text format), an opt-in sampling profiler, and the stage report of the nightly scripts
+
+# Import relevant libraries
+
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import config
+
+"""
+Histograms count observations into cumulative buckets per combination of label values, like a Prometheus client would:
+request_seconds = every request, labelled with its route, method and status (init_app)
+span_seconds = timed sections of the hot paths, labelled with the span name (span() / timed())
+Gauges are read from a function when /metrics is scraped (e.g. the paper cache's hit rate). The numbers are per app
+process; Prometheus sums them over the processes it scrapes.
+When config.PROFILING is on, adding profile=1 to any request URL runs a sampling profiler on the request thread and
+returns its collapsed stacks (one 'outer;inner;... count' line per stack, the input format of flamegraph tools) instead
+of the page.
+StageReport times the stages of the nightly scripts and writes them as one JSON report (seconds, items and items/sec
+for every stage, and papers/sec for the whole run).
+"""
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REPORT_DIR = '../data/reports'
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.series.get(label_values)
+            if counts is None:
+                counts = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            at = bisect.bisect_left(self.buckets, value)
+            if at < len(self.buckets):
+                counts[0][at] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    # Lines of the histogram in the Prometheus text format
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' histogram']
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                labels = [k + '="' + escape(v) + '"' for k, v in zip(self.labels, label_values)]
+                cumulative = 0
+                for le, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(self.name + '_bucket{' + ','.join(labels + ['le="' + str(le) + '"']) + '} ' + str(cumulative))
+                lines.append(self.name + '_bucket{' + ','.join(labels + ['le="+Inf"']) + '} ' + str(count))
+                lines.append(self.name + '_sum' + ('{' + ','.join(labels) + '}' if len(labels) > 0 else '') + ' ' + repr(total))
+                lines.append(self.name + '_count' + ('{' + ','.join(labels) + '}' if len(labels) > 0 else '') + ' ' + str(count))
+        return lines
+
+
+# Escape a label value for the text format
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+request_seconds = Histogram('ajar_request_seconds', 'Time to answer a request', ('route', 'method', 'status'))
+span_seconds = Histogram('ajar_span_seconds', 'Time spent in instrumented sections of the hot paths', ('span',))
+histograms = [request_seconds, span_seconds]
+gauges = {}
+
+# Register a gauge, read from fn() whenever the metrics are rendered
+def gauge(name, help_text, fn):
+    gauges[name] = (help_text, fn)
+
+# Time a block of code as a span
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_seconds.observe(time.perf_counter() - start, name)
+
+# Decorator which times every call of a function as a span
+def timed(name):
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Every metric in the Prometheus text format
+def render():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+    for name, (help_text, fn) in sorted(gauges.items()):
+        lines += ['# HELP ' + name + ' ' + help_text, '# TYPE ' + name + ' gauge', name + ' ' + repr(float(fn()))]
+    return '\n'.join(lines) + '\n'
+
+
+# Sampling profiler for one thread - a helper thread records the thread's stack every interval seconds
+class SamplingProfiler:
+
+    def __init__(self, thread_id=None, interval=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval or config.PROFILE_INTERVAL
+        self.stacks = Counter()
+        self.running = False
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(os.path.basename(frame.f_code.co_filename) + ':' + frame.f_code.co_name)
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    # Collapsed stacks, most sampled first
+    def report(self):
+        return '\n'.join([stack + ' ' + str(n) for stack, n in self.stacks.most_common()]) + '\n'
+
+
+# Time every request by route, serve /metrics, and profile requests with profile=1 when config.PROFILING is on
+def init_app(app):
+    from flask import g, request, Response
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        if config.PROFILING and request.args.get('profile') == '1':
+            g.profiler = SamplingProfiler()
+            g.profiler.start()
+
+    @app.after_request
+    def stop_timer(response):
+        if 'metrics_start' in g:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            request_seconds.observe(time.perf_counter() - g.pop('metrics_start'), route, request.method, response.status_code)
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            return Response(profiler.report(), mimetype='text/plain')
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+# Stage timings of a nightly run, written as a JSON report
+class StageReport:
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.details = {}
+        self.started = time.perf_counter()
+
+    # Time a stage. items (e.g. papers processed) can be given up front or set on the yielded dictionary
+    @contextmanager
+    def stage(self, name, items=None):
+        entry = {'stage': name, 'items': items}
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            self.add(name, time.perf_counter() - start, entry['items'])
+
+    # Record a stage timed elsewhere (e.g. by the text pipeline's workers)
+    def add(self, name, seconds, items=None):
+        rate = items / seconds if items is not None and seconds > 0 else None
+        self.stages.append({'stage': name, 'seconds': round(seconds, 3), 'items': items, 'per_second': None if rate is None else round(rate, 1)})
+
+    # Record other results of the run (e.g. the near-duplicates found) under name in the report
+    def detail(self, name, value):
+        self.details[name] = value
+
+    # The report as a dictionary, with the whole run's papers/sec
+    def summary(self, papers):
+        seconds = time.perf_counter() - self.started
+        return {'run': self.name, 'seconds': round(seconds, 3), 'papers': papers,
+                'papers_per_second': round(papers / seconds, 2) if seconds > 0 else None, 'stages': self.stages, **self.details}
+
+    # Print the report and save it to REPORT_DIR/<name>.json
+    def write(self, papers, report_dir=REPORT_DIR):
+        summary = self.summary(papers)
+        print(json.dumps(summary, indent=1))
+        os.makedirs(report_dir, exist_ok=True)
+        with open(os.path.join(report_dir, self.name + '.json'), 'w') as f:
+            json.dump(summary, f, indent=1)
+        return summary
@@ -0,0 +1,193 @@
+# Near-duplicate detection for the daily collection - MinHash signatures of the papers' abstracts with an LSH index, so reposted, corrected or cross-listed papers already in the archive are caught before they are stored again
+
+# Import relevant libraries
+
+import os
+import json
+import zlib
+import numpy as np
+import text_pipeline
+
+"""
+Each abstract is cut into shingles of SHINGLE consecutive words of its parsed (lemmatized) text and summarized by a
+signature of NUM_PERM 32 bit MinHash values - the share of equal values between two signatures estimates the Jaccard
+similarity of their shingle sets. Signatures are split into BANDS bands of NUM_PERM // BANDS values; two papers whose
+signatures agree on a whole band are candidates, and a candidate is a near-duplicate when its estimated similarity is at
+least THRESHOLD. With 16 bands of 4 a pair at THRESHOLD is a candidate with probability 1 - (1 - 0.8 ** 4) ** 16 = 0.9998
+(8 bands of 8 would miss nearly a quarter of them).
+The store sits next to the features in ../data/features/minhash:
+signatures.bin = NUM_PERM uint32 values per paper (row = paper id - 1), appended to every night
+band_keys.npy, band_rows.npy = (BANDS, papers) arrays - per band, the 64 bit hash of every paper's band sorted, and the row it came from
+meta.json = number of papers covered and number of bands, written last - a store with another number of bands is rebuilt
+A lookup is a binary search per band, so checking a day's papers does not depend on scanning the archive.
+"""
+
+SIGNATURE_DIR = '../data/features/minhash'
+NUM_PERM = 64
+BANDS = 16
+SHINGLE = 3
+THRESHOLD = 0.8
+PRIME = np.uint64(4294967311)
+MASK = np.uint64(0xffffffff)
+
+# Fixed random hash functions (a * x + b) mod PRIME, so signatures from different runs are comparable
+rng = np.random.default_rng(20200908)
+HASH_A = rng.integers(1, 2 ** 31, NUM_PERM, dtype=np.uint64)
+HASH_B = rng.integers(0, 2 ** 32, NUM_PERM, dtype=np.uint64)
+
+
+# Hashes of the word shingles of a parsed abstract
+def shingles(text):
+    words = text.split()
+    grams = set(' '.join(words[x:x + SHINGLE]) for x in range(max(1, len(words) - SHINGLE + 1)))
+    return np.array([zlib.crc32(x.encode('utf-8')) for x in grams if len(x) > 0], dtype=np.uint64)
+
+# MinHash signature of a parsed abstract (all values 0xffffffff for an empty one)
+def signature(text):
+    hashes = shingles(text)
+    if len(hashes) == 0:
+        return np.full(NUM_PERM, 0xffffffff, dtype=np.uint32)
+    return (((HASH_A[:, None] * hashes[None, :] + HASH_B[:, None]) % PRIME) & MASK).min(axis=1).astype(np.uint32)
+
+# Signatures of several parsed abstracts, one row each
+def signatures(texts):
+    texts = list(texts)
+    if len(texts) == 0:
+        return np.zeros((0, NUM_PERM), dtype=np.uint32)
+    return np.vstack([signature(x) for x in texts])
+
+# 64 bit hash (FNV-1a over the values) of every band of every signature, shape (papers, BANDS)
+def band_keys(sigs):
+    rows = NUM_PERM // BANDS
+    bands = sigs.reshape(len(sigs), BANDS, rows).astype(np.uint64)
+    keys = np.full((len(sigs), BANDS), 14695981039346656037, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for x in range(rows):
+            keys = (keys ^ bands[:, :, x]) * np.uint64(1099511628211)
+    return keys
+
+
+class SignatureStore:
+
+    def __init__(self, sigs, keys, rows, n_rows):
+        self.sigs = sigs
+        self.keys = keys
+        self.rows = rows
+        self.n_rows = n_rows
+
+    # Rows of archived papers that share a band with a signature (rows a failed run stored beyond the archive are left out)
+    def candidates(self, keys):
+        found = set()
+        for band in range(BANDS):
+            lo = np.searchsorted(self.keys[band], keys[band], side='left')
+            hi = np.searchsorted(self.keys[band], keys[band], side='right')
+            found.update(int(x) for x in self.rows[band][lo:hi] if x < self.n_rows)
+        return sorted(found)
+
+
+# Estimated Jaccard similarity of two signatures
+def similarity(a, b):
+    return float(np.mean(a == b))
+
+# For every new signature: the paper id of an archived near-duplicate, -(j + 1) if it is a near-duplicate of new paper j before it, or 0
+def find_duplicates(sigs, store=None, threshold=THRESHOLD):
+    keys = band_keys(sigs)
+    duplicate_of = np.zeros(len(sigs), dtype=np.int64)
+    seen = [{} for x in range(BANDS)]
+    for n in range(len(sigs)):
+        if store is not None:
+            for row in store.candidates(keys[n]):
+                if similarity(sigs[n], store.sigs[row]) >= threshold:
+                    duplicate_of[n] = row + 1
+                    break
+        if duplicate_of[n] == 0:
+            earlier = sorted(set(j for band in range(BANDS) for j in seen[band].get(keys[n, band], [])))
+            for j in earlier:
+                if similarity(sigs[n], sigs[j]) >= threshold:
+                    duplicate_of[n] = -(j + 1)
+                    break
+        for band in range(BANDS):
+            seen[band].setdefault(keys[n, band], []).append(n)
+    return duplicate_of
+
+
+# Number of papers the store covers, None if there is no store or it was built with another number of bands
+def stored_rows(signature_dir=SIGNATURE_DIR):
+    path = os.path.join(signature_dir, 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    return meta['rows'] if meta.get('bands') == BANDS else None
+
+# Open the store for the first n_rows papers (signatures memory-mapped). Returns None if it covers fewer papers. It can cover more when a run failed after updating it - those rows are ignored, and replaced by the next update
+def load(n_rows, signature_dir=SIGNATURE_DIR):
+    stored = stored_rows(signature_dir)
+    if stored is None or stored < n_rows:
+        return None
+    if stored == 0:
+        return SignatureStore(np.zeros((0, NUM_PERM), dtype=np.uint32), np.zeros((BANDS, 0), dtype=np.uint64), np.zeros((BANDS, 0), dtype=np.int32), 0)
+    sigs = np.memmap(os.path.join(signature_dir, 'signatures.bin'), dtype=np.uint32, mode='r', shape=(stored, NUM_PERM))
+    keys = np.load(os.path.join(signature_dir, 'band_keys.npy'), mmap_mode='r')
+    rows = np.load(os.path.join(signature_dir, 'band_rows.npy'), mmap_mode='r')
+    return SignatureStore(sigs, keys, rows, n_rows)
+
+# Add the signatures of papers n_old onwards to the store. Signatures are appended to signatures.bin (after cutting off any rows beyond n_old a failed run left) and each band's sorted keys take in the new keys
+def update(sigs, n_old, signature_dir=SIGNATURE_DIR):
+    os.makedirs(signature_dir, exist_ok=True)
+    path = os.path.join(signature_dir, 'signatures.bin')
+    stored = stored_rows(signature_dir)
+    if stored is None or stored < n_old:
+        raise RuntimeError('signature store does not cover the ' + str(n_old) + ' archived papers')
+    with open(path, 'ab') as f:
+        f.truncate(n_old * NUM_PERM * 4)
+        f.write(np.ascontiguousarray(sigs, dtype=np.uint32).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    new_keys = band_keys(sigs).T
+    new_rows = np.arange(n_old, n_old + len(sigs), dtype=np.int32)
+    if n_old > 0:
+        old_keys = np.load(os.path.join(signature_dir, 'band_keys.npy'))
+        old_rows = np.load(os.path.join(signature_dir, 'band_rows.npy'))
+        if stored > n_old:
+            kept = old_rows < n_old
+            old_keys = old_keys[kept].reshape(BANDS, n_old)
+            old_rows = old_rows[kept].reshape(BANDS, n_old)
+    else:
+        old_keys, old_rows = np.zeros((BANDS, 0), dtype=np.uint64), np.zeros((BANDS, 0), dtype=np.int32)
+    keys = np.empty((BANDS, n_old + len(sigs)), dtype=np.uint64)
+    rows = np.empty((BANDS, n_old + len(sigs)), dtype=np.int32)
+    for band in range(BANDS):
+        order = np.argsort(new_keys[band], kind='stable')
+        at = np.searchsorted(old_keys[band], new_keys[band][order], side='right')
+        keys[band] = np.insert(old_keys[band], at, new_keys[band][order])
+        rows[band] = np.insert(old_rows[band], at, new_rows[order])
+    for name, value in [('band_keys', keys), ('band_rows', rows)]:
+        with open(os.path.join(signature_dir, name + '.npy.tmp'), 'wb') as f:
+            np.save(f, value)
+        os.replace(os.path.join(signature_dir, name + '.npy.tmp'), os.path.join(signature_dir, name + '.npy'))
+    with open(os.path.join(signature_dir, 'meta.json.tmp'), 'w') as f:
+        json.dump({'rows': n_old + len(sigs), 'bands': BANDS}, f)
+    os.replace(os.path.join(signature_dir, 'meta.json.tmp'), os.path.join(signature_dir, 'meta.json'))
+
+# Build the store for the first n_rows archived papers from the papers table (abstracts parsed like the text pipeline does), in batches of batch papers
+def build(cnxn, n_rows, signature_dir=SIGNATURE_DIR, batch=10000):
+    os.makedirs(signature_dir, exist_ok=True)
+    with open(os.path.join(signature_dir, 'meta.json'), 'w') as f:
+        json.dump({'rows': 0, 'bands': BANDS}, f)
+    cursor = cnxn.cursor()
+    cursor.execute("SELECT id, abstract FROM papers WHERE id <= ? ORDER BY id", (n_rows,))
+    n = 0
+    while True:
+        rows = cursor.fetchmany(batch)
+        if len(rows) == 0:
+            break
+        if rows[-1][0] != n + len(rows):
+            raise RuntimeError('paper ids are not consecutive, cannot build the signature store')
+        update(signatures([text_pipeline.parser(x[1]) for x in rows]), n, signature_dir)
+        n += len(rows)
+    cursor.close()
+    if n != n_rows:
+        raise RuntimeError('the papers table has ' + str(n) + ' of the ' + str(n_rows) + ' archived papers')
+    return load(n, signature_dir)
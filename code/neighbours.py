@@ -0,0 +1,131 @@
+# Precomputed nearest-neighbour table - the K most similar papers for every paper in the archive
+
+# Import relevant libraries
+
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from similarity import SimilarityEngine
+import config
+
+"""
+The table is two .npy files with one row per paper (row = paper id - 1) and K columns, sorted by descending score:
+neighbour_ids.npy = int32 feature row numbers of the neighbours (-1 for an empty slot)
+neighbour_scores.npy = float32 cosine scores (-inf for an empty slot)
+neighbour_ids.json = feature space (config.FEATURE_SPACE) the scores were computed in, written last - a table from another space is not used, and rebuilt
+Both are opened with mmap_mode='r', so looking up a paper's neighbours only touches one row of each file.
+The table is written before the day's papers are published, so it can cover more rows than the live feature matrix
+(while the load runs, or after it failed) - readers pass the number of live rows and those beyond it are ignored.
+The daily collection script calls update() after appending the day's features: only the new rows are scored (in blocks)
+against the whole matrix, so the nightly cost is (new papers x archive size) rather than archive size squared.
+"""
+
+IDS_PATH = '../data/neighbour_ids.npy'
+SCORES_PATH = '../data/neighbour_scores.npy'
+K = 10
+BLOCK = 10000
+CHUNK = 1000
+
+# File recording the feature space of a table
+def meta_path(ids_path):
+    return os.path.splitext(ids_path)[0] + '.json'
+
+# Record that a table was computed in the current feature space
+def write_meta(ids_path=IDS_PATH):
+    with open(meta_path(ids_path) + '.tmp', 'w') as f:
+        json.dump({'space': config.FEATURE_SPACE}, f)
+    os.replace(meta_path(ids_path) + '.tmp', meta_path(ids_path))
+
+# Feature space a table was computed in, None if it is not recorded
+def stored_space(ids_path=IDS_PATH):
+    if not os.path.exists(meta_path(ids_path)):
+        return None
+    with open(meta_path(ids_path)) as f:
+        return json.load(f)['space']
+
+# Load the neighbour table as read only memory maps. Returns (None, None) if it has not been built yet or belongs to another feature space
+# With n_rows (the rows of the live feature matrix) only the rows of published papers are returned, see lookup for their neighbours
+def load(n_rows=None, ids_path=IDS_PATH, scores_path=SCORES_PATH):
+    if not (os.path.exists(ids_path) and os.path.exists(scores_path)) or stored_space(ids_path) != config.FEATURE_SPACE:
+        return None, None
+    ids, scores = np.load(ids_path, mmap_mode='r'), np.load(scores_path, mmap_mode='r')
+    if n_rows is not None and ids.shape[0] > n_rows:
+        ids, scores = ids[:n_rows], scores[:n_rows]
+    return ids, scores
+
+# Returns the feature rows of up to num stored neighbours of a row with a score above the threshold, or None if the table cannot answer (row not in the table yet, num > K, or a neighbour is a row beyond the table - a paper that was not published)
+def lookup(ids, scores, row, num, threshold):
+    if ids is None or row >= ids.shape[0] or num > ids.shape[1]:
+        return None
+    keep = scores[row, :num] > threshold
+    found = ids[row, :num][keep]
+    if (found >= ids.shape[0]).any():
+        return None
+    return [int(x) for x in found]
+
+# Function which merges two sets of candidates (2D id and score arrays with the same number of rows) and keeps the k best per row, highest score first
+def merge(ids_a, scores_a, ids_b, scores_b, k):
+    ids = np.hstack([ids_a, ids_b])
+    scores = np.hstack([scores_a, scores_b])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    ids = np.take_along_axis(ids, part, axis=1)
+    scores = np.take_along_axis(scores, part, axis=1)
+    order = np.lexsort((ids, -scores), axis=1)
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+# Add rows n_old: of the feature matrix to the table. Each chunk of new rows is scored against the whole matrix one block of rows at a time; the new rows keep their best K matches and the old rows in each block take in any new paper that beats their current K-th neighbour
+# The table is written to a temporary file and swapped in with os.replace, so readers never see a half written table. If the stored table covers fewer than n_old rows or was computed in another feature space it is rebuilt from scratch
+# A table covering more rows was written by a run whose load failed: those rows are dropped, and the old rows that had taken one of them in as a neighbour are scored against the archive again
+def update(features, n_old, ids_path=IDS_PATH, scores_path=SCORES_PATH, k=K, block=BLOCK, chunk=CHUNK):
+    n = features.shape[0]
+    old_ids, old_scores = load(None, ids_path, scores_path)
+    if old_ids is None or old_ids.shape[0] < n_old or old_ids.shape[1] != k:
+        n_old = 0
+    engine = SimilarityEngine(features)
+
+    ids = open_memmap(ids_path + '.tmp', mode='w+', dtype=np.int32, shape=(n, k))
+    scores = open_memmap(scores_path + '.tmp', mode='w+', dtype=np.float32, shape=(n, k))
+    if n_old > 0:
+        ids[:n_old] = old_ids[:n_old]
+        scores[:n_old] = old_scores[:n_old]
+    ids[n_old:] = -1
+    scores[n_old:] = -np.inf
+
+    stale = np.flatnonzero((ids[:n_old] >= n_old).any(axis=1))
+    for q0 in range(0, len(stale), chunk):
+        rows = stale[q0:q0 + chunk]
+        row_ids, row_scores = np.full((len(rows), k), -1, dtype=np.int32), np.full((len(rows), k), -np.inf, dtype=np.float32)
+        for c0 in range(0, n_old, block):
+            c1 = min(c0 + block, n_old)
+            block_scores = engine.scores(features[rows], c0, c1).astype(np.float32)
+            inside = (rows >= c0) & (rows < c1)
+            block_scores[np.flatnonzero(inside), rows[inside] - c0] = -np.inf
+            cols = np.broadcast_to(np.arange(c0, c1, dtype=np.int32), block_scores.shape)
+            row_ids, row_scores = merge(row_ids, row_scores, cols, block_scores, k)
+        ids[rows], scores[rows] = row_ids, row_scores
+
+    for q0 in range(n_old, n, chunk):
+        q1 = min(q0 + chunk, n)
+        query = features[q0:q1]
+        for c0 in range(0, n, block):
+            c1 = min(c0 + block, n)
+            block_scores = engine.scores(query, c0, c1).astype(np.float32)
+
+            # A paper is not its own neighbour
+            same = np.arange(max(q0, c0), min(q1, c1))
+            block_scores[same - q0, same - c0] = -np.inf
+
+            cols = np.broadcast_to(np.arange(c0, c1, dtype=np.int32), block_scores.shape)
+            ids[q0:q1], scores[q0:q1] = merge(ids[q0:q1], scores[q0:q1], cols, block_scores, k)
+            if c0 < n_old:
+                o1 = min(c1, n_old)
+                new_rows = np.broadcast_to(np.arange(q0, q1, dtype=np.int32), (o1 - c0, q1 - q0))
+                ids[c0:o1], scores[c0:o1] = merge(ids[c0:o1], scores[c0:o1], new_rows, block_scores[:, :o1 - c0].T, k)
+
+    ids.flush()
+    scores.flush()
+    del ids, scores, old_ids, old_scores
+    os.replace(ids_path + '.tmp', ids_path)
+    os.replace(scores_path + '.tmp', scores_path)
+    write_meta(ids_path)
@@ -0,0 +1,97 @@
+# Paper metadata cache - read-through LRU cache of the papers table rows the app displays (titles for result lists, full rows for paper pages)
+
+# Import relevant libraries
+
+import os
+import threading
+from collections import OrderedDict
+import config
+
+"""
+Papers never change once they are stored, and the same few (the day's recommendations, popular searches) are shown over
+and over, so the app keeps paper rows in memory: paper id -> (title, abstract, authors, journal, link, date).
+get_many looks up every id it is asked for in the cache and fetches all the misses in one id IN (...) query (in batches
+of BATCH ids, under SQL Server's parameter limit); the least recently used rows are dropped once there are more than
+config.PAPER_CACHE_SIZE. Hit and miss counters are kept for monitoring (stats()).
+daily_collection.py touches VERSION_PATH after it has written to the papers table; check() clears the cache when that
+file's modification time changes, so every app process drops its rows after a nightly run.
+"""
+
+VERSION_PATH = '../data/papers.version'
+COLUMNS = 'title, abstract, authors, journal, link, date, id'
+BATCH = 500
+
+
+class PaperCache:
+
+    def __init__(self, size=None, version_path=VERSION_PATH):
+        self.size = size or config.PAPER_CACHE_SIZE
+        self.version_path = version_path
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = self.mtime()
+
+    # Modification time of the version file, None if it does not exist yet
+    def mtime(self):
+        try:
+            return os.stat(self.version_path).st_mtime_ns
+        except OSError:
+            return None
+
+    # Clear the cache if daily_collection.py has touched the version file since the last check
+    def check(self):
+        version = self.mtime()
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    # Rows {paper id: (title, abstract, authors, journal, link, date)} of the ids found in the papers table, cached rows first and the rest from one query
+    def get_many(self, cnxn, ids):
+        ids = [int(x) for x in ids]
+        found, missing = {}, []
+        with self.lock:
+            for x in ids:
+                row = self.rows.get(x)
+                if row is None:
+                    missing.append(x)
+                else:
+                    self.rows.move_to_end(x)
+                    found[x] = row
+            self.hits += len(found)
+            self.misses += len(missing)
+        missing = list(dict.fromkeys(missing))
+        for x in range(0, len(missing), BATCH):
+            batch = missing[x:x + BATCH]
+            cursor = cnxn.cursor()
+            try:
+                rows = cursor.execute("SELECT " + COLUMNS + " FROM papers WHERE id IN (" + ','.join(['?'] * len(batch)) + ")", tuple(batch)).fetchall()
+            finally:
+                cursor.close()
+            with self.lock:
+                for row in rows:
+                    found[row[-1]] = tuple(row[:-1])
+                    self.rows[row[-1]] = found[row[-1]]
+                while len(self.rows) > self.size:
+                    self.rows.popitem(last=False)
+        return found
+
+    # Row of one paper, None if there is no such paper
+    def get(self, cnxn, pid):
+        return self.get_many(cnxn, [pid]).get(int(pid))
+
+    # Hit and miss counts, hit rate and number of cached rows
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'size': len(self.rows)}
+
+
+# Tell every app process to drop its cached paper rows (run after the papers table has changed)
+def touch(version_path=VERSION_PATH):
+    with open(version_path, 'a'):
+        os.utime(version_path, None)
@@ -0,0 +1,85 @@
+# Daily recommendation scoring - matches users' favorites (or favorite cluster centroids) against the papers from one day
+
+# Import relevant libraries
+
+import numpy as np
+from scipy import sparse
+from similarity import select_top, normalize_rows
+import cluster_cache
+import catalog
+
+"""
+All centroids (of one user, or of many users at once) are stacked into a single matrix and scored against the day's
+slice of the feature matrix with one product. Each user's score for a paper is the best score over that user's centroids,
+favorites are masked out with np.isin, and the top papers per user are picked with np.argpartition.
+Optionally the day's papers are first narrowed down by journal: a paper is only scored for a user when the centroid of
+its journal (see summaries.py) scores at least a prefilter threshold against one of the user's centroids.
+Paper ids and feature rows are synced (row = id - 1). The papers of one day are a contiguous block of ids, or a few
+blocks when the day was ingested more than once - the day is given as id ranges (see catalog.Catalog.day) and only the
+rows inside them are scored.
+"""
+
+# Feature vectors used to match a user's favorites against the daily papers: the favorites themselves for 5 or fewer, otherwise the centroids of their K-Means clusters (see cluster_cache)
+# matches(paper id, num) returns ids of papers similar to a favorite, used to "bolster" small favorite lists before clustering. With a user id, the user's cached clusters are updated instead of refitting
+def user_centroids(features, fav_ids, matches, user=None):
+    if len(fav_ids) == 0:
+        return sparse.csr_matrix((0, features.shape[1]))
+    if user is None:
+        return cluster_cache.fit(features, [int(x) for x in fav_ids], matches)['sums']
+    return cluster_cache.centroids(user, features, fav_ids, matches)
+
+# Turn one user's centroids (sparse matrix, np.matrix, 2D array or list of vectors) into a 2D matrix with one row per centroid
+def as_rows(centroids):
+    if sparse.issparse(centroids):
+        return sparse.csr_matrix(centroids)
+    return np.asarray(np.vstack([x.toarray() if sparse.issparse(x) else x for x in centroids]))
+
+# Stack several users' centroid matrices into one matrix, staying sparse when every part is sparse
+def stack(parts):
+    if all(sparse.issparse(x) for x in parts):
+        return sparse.vstack(parts, format='csr')
+    return np.vstack([x.toarray() if sparse.issparse(x) else x for x in parts])
+
+# Recommendations for several users in one pass. centroids is a list (one entry per user) of centroid rows, favorites a list of each user's favorite paper ids, ranges the id ranges [(first id, last id), ...] of the day's papers
+# Users are scored in groups of up to group_size so the dense score matrix stays bounded. Returns a list of (paper ids, scores) per user, best first
+# journals = (journal number of every feature row, unit length journal centroids) turns on the journal prefilter with threshold prefilter
+def batch_daily_matches(engine, centroids, favorites, ranges, num=5, threshold=0.2, group_size=256, journals=None, prefilter=0.0):
+    day_ids = catalog.range_ids(ranges)
+    results = [(np.array([], dtype=np.int64), np.array([]))] * len(centroids)
+    users = [x for x in range(len(centroids)) if (centroids[x].shape[0] if sparse.issparse(centroids[x]) else len(centroids[x])) > 0]
+    for g in range(0, len(users), group_size):
+        group = users[g:g + group_size]
+        parts = [as_rows(centroids[x]) for x in group]
+        counts = [x.shape[0] for x in parts]
+        if journals is None:
+            query = stack(parts)
+            scores = np.hstack([engine.scores(query, a - 1, b) for a, b in ranges])
+        else:
+            scores = prefiltered_scores(engine, stack(parts), counts, day_ids - 1, journals, prefilter)
+        best = np.maximum.reduceat(scores, np.cumsum([0] + counts[:-1]), axis=0)
+        for row, user in zip(best, group):
+            row[np.isin(day_ids, favorites[user])] = -np.inf
+            top, top_scores = select_top(row, num, threshold)
+            results[user] = (day_ids[top], top_scores)
+    return results
+
+# Scores of the stacked centroids of several users (counts = number of centroids of each) against feature rows (ascending), except that a row is only scored for a user if its journal's centroid scores at least prefilter against one of the user's centroids - all other rows get -inf
+# Only rows kept for some user in the group are scored, so journals nobody in the group is close to cost nothing
+def prefiltered_scores(engine, query, counts, rows, journals, prefilter):
+    codes, journal_unit = journals
+    present, row_journal = np.unique(np.asarray(codes)[rows], return_inverse=True)
+    journal_scores = normalize_rows(query) @ journal_unit[present].T
+    journal_scores = np.asarray(journal_scores.toarray() if sparse.issparse(journal_scores) else journal_scores)
+    keep = np.maximum.reduceat(journal_scores, np.cumsum([0] + counts[:-1]), axis=0) >= prefilter
+    keep = np.repeat(keep[:, row_journal], counts, axis=0)
+    cols = np.flatnonzero(keep.any(axis=0))
+    out = np.full((query.shape[0], len(rows)), -np.inf)
+    if len(cols) > 0:
+        out[:, cols] = engine.row_scores(query, rows[cols])
+    out[~keep] = -np.inf
+    return out
+
+# Recommendations for a single user's centroids. Returns a list of paper ids, best first
+def daily_matches(engine, centroids, favorites, ranges, num=5, threshold=0.2, journals=None, prefilter=0.0):
+    ids, scores = batch_daily_matches(engine, [centroids], [favorites], ranges, num, threshold, journals=journals, prefilter=prefilter)[0]
+    return [int(x) for x in ids]
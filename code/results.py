@@ -0,0 +1,84 @@
+# Server-side cache of result lists (search results, journal listings) and the cursors the results pages use to page through them
+
+# Import relevant libraries
+
+import time
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from itsdangerous import URLSafeSerializer, BadSignature
+import config
+
+"""
+A result list is computed once and kept in this process under a hash of what produced it (kind of list, its parameters
+and the feature version), instead of being written into the session cookie on every request. Paper ids are stored as a
+compact array('i') (4 bytes an id), journal names as a tuple. Entries expire after config.RESULT_CACHE_TTL seconds and
+the least recently used entry is dropped once there are more than config.RESULT_CACHE_SIZE.
+The previous/next buttons carry an opaque cursor - the kind, parameters and offset of the page, signed with the app's
+secret key - so a page can always be served, recomputing the list if its entry has expired or was made by another
+worker process. Each entry also keeps the titles of the pages already looked up; the app looks up the titles of the page
+after the one shown in the background, so 'Next' usually needs no database query.
+"""
+
+PAGE = 10
+
+
+# Result list of the cache: ids (array('i') of paper ids or tuple of journal names) and the titles of pages already looked up {offset: titles}
+class Entry:
+
+    def __init__(self, ids):
+        self.ids = array('i', ids) if len(ids) == 0 or not isinstance(ids[0], str) else tuple(ids)
+        self.titles = {}
+        self.created = time.monotonic()
+
+
+# Thread safe LRU cache of entries with a time to live
+class ResultCache:
+
+    def __init__(self, size=None, ttl=None):
+        self.size = size or config.RESULT_CACHE_SIZE
+        self.ttl = ttl or config.RESULT_CACHE_TTL
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+# Cache key of a result list
+def key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# Signs and reads the page cursors handed to the browser
+class Cursors:
+
+    def __init__(self, secret):
+        self.serializer = URLSafeSerializer(secret, salt='results')
+
+    def encode(self, kind, params, offset):
+        return self.serializer.dumps([kind, list(params), offset])
+
+    # (kind, params, offset) of a cursor, None if it is not one of ours
+    def decode(self, cursor):
+        try:
+            kind, params, offset = self.serializer.loads(cursor)
+        except BadSignature:
+            return None
+        return kind, tuple(params), int(offset)
@@ -0,0 +1,94 @@
+# Similarity engine used for paper-to-paper and favorites-to-paper matching
+
+# Import relevant libraries
+
+import numpy as np
+from scipy import sparse
+
+"""
+Row norms of the feature matrix are computed once when the engine is created, so scoring a query is a single sparse
+matrix-vector product divided by the stored norms (no copy of the feature matrix is made). The best rows are then
+picked with np.argpartition instead of fully sorting every score, and ties are broken by row index so identical
+scores always map back to the right paper.
+Row numbers returned by the engine are feature matrix indices, which are paper id - 1.
+"""
+
+# Function which returns the L2 norm of every row of a sparse or dense matrix. Empty rows are given a norm of 1 so they score 0 instead of dividing by zero
+def row_norms(matrix):
+    if hasattr(matrix, 'shards'):
+        # Sharded feature store matrix (feature_store.ShardedMatrix)
+        return np.concatenate([row_norms(x) for x in matrix.shards])
+    if hasattr(matrix, 'idf'):
+        # Hashed counts weighted by their IDF (hashing.HashedFeatures)
+        return matrix.row_norms()
+    if sparse.issparse(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    else:
+        norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+    norms[norms == 0] = 1
+    return norms
+
+# Function which scales each query row to unit length. Sparse queries stay sparse, anything else (lists, np.matrix, arrays) becomes a 2D float array
+def normalize_rows(rows):
+    if sparse.issparse(rows):
+        rows = sparse.csr_matrix(rows, dtype=np.float64)
+        return sparse.diags(1 / row_norms(rows)) @ rows
+    rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+    return rows / row_norms(rows)[:, None]
+
+# Function which picks the k highest scores of a 1D score array (highest first, lower index first on ties), keeping only scores above the threshold
+def select_top(scores, k, threshold=None):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=scores.dtype)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.lexsort((top, -scores[top]))]
+    if threshold is not None:
+        top = top[scores[top] > threshold]
+    return top, scores[top]
+
+
+class SimilarityEngine:
+
+    # norms can be passed in when they were precomputed (see feature_store), otherwise they are calculated here
+    def __init__(self, features, norms=None):
+        self.features = features
+        self.norms = row_norms(features) if norms is None else norms
+
+    # Cosine scores of every query row against feature rows start:stop (the whole matrix by default). Returns a dense array of shape (queries, rows)
+    def scores(self, query_rows, start=0, stop=None):
+        stop = self.features.shape[0] if stop is None else stop
+        block = self.features if (start, stop) == (0, self.features.shape[0]) else self.features[start:stop]
+        query = normalize_rows(query_rows)
+        if isinstance(block, np.ndarray):
+            # Dense (embedding) features - score in the matrix's own precision so the block is never upcast
+            query = (query.toarray() if sparse.issparse(query) else query).astype(block.dtype)
+        scores = block @ query.T
+        if sparse.issparse(scores):
+            scores = scores.toarray()
+        return np.asarray(scores).T / self.norms[start:stop]
+
+    # Cosine scores of every query row against a set of feature rows (row indices of the whole matrix). Returns a dense array of shape (queries, rows)
+    def row_scores(self, query_rows, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        query = normalize_rows(query_rows)
+        block = self.features[rows]
+        if isinstance(block, np.ndarray):
+            query = (query.toarray() if sparse.issparse(query) else query).astype(block.dtype)
+        scores = block @ query.T
+        if sparse.issparse(scores):
+            scores = scores.toarray()
+        return np.asarray(scores).T / self.norms[rows]
+
+    # Top k rows above the threshold for each query row. exclude is an optional list (one entry per query) of row indices that may not be returned, e.g. the query paper itself
+    # Returns a list of (rows, scores) array pairs, one per query, with rows counted from 0 of the whole matrix
+    def top_k(self, query_rows, k=5, threshold=None, exclude=None, start=0, stop=None):
+        scores = self.scores(query_rows, start, stop)
+        results = []
+        for i, row in enumerate(scores):
+            if exclude is not None and len(exclude[i]) > 0:
+                skip = np.asarray(exclude[i], dtype=np.int64) - start
+                row[skip[(skip >= 0) & (skip < len(row))]] = -np.inf
+            top, top_scores = select_top(row, k, threshold)
+            results.append((top + start, top_scores))
+        return results
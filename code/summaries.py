@@ -0,0 +1,134 @@
+# Journal and day summaries - running sums of the papers' unit length feature vectors per journal and per publication day, so topic level views of journals (representative papers, related journals) are one small product instead of a scan of every paper
+
+# Import relevant libraries
+
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+from similarity import normalize_rows, select_top
+import config
+
+"""
+The summaries are one matrix with a row per journal (in the paper catalog's journal numbering, see catalog.py) followed
+by a row per publication day (in date order): each row is the sum of the unit length vectors of the matrix used for
+similarity (config.FEATURE_SPACE) of its papers, with the number of papers in counts. A row scaled to unit length is
+the direction of its journal or day, so cosine similarity against it tells how typical a paper is of a journal, how
+close two journals are, or whether a journal is worth scoring for a user at all.
+It is saved as one pickle at ../data/summaries.pkl and extended by the nightly collection with the day's papers (only
+the new rows are read). The state it was extended from is kept as summaries.pkl.prev, which is used instead when a run
+added papers but failed to load them. It is rebuilt from every row when neither covers the papers before the new ones
+or it was made in another feature space. With the hashed features each paper is added with the IDF of the day it was collected.
+"""
+
+SUMMARIES_PATH = '../data/summaries.pkl'
+CHUNK = 50000
+
+
+# Summaries of n_journals journals and the days in days (date strings, sorted)
+class Summaries:
+
+    def __init__(self, rows, space, journals, days, sums, counts):
+        self.rows = rows
+        self.space = space
+        self.journals = journals
+        self.days = days
+        self.sums = sums
+        self.counts = counts
+        self.unit = sparse.csr_matrix(normalize_rows(sums))
+        self.journal_unit = self.unit[:journals]
+        self.day_unit = self.unit[journals:]
+
+    # Unit length centroid of a day's papers (1 x features), None if no paper was published on that day
+    def day(self, day):
+        n = np.searchsorted(self.days, day)
+        if n == len(self.days) or self.days[n] != day:
+            return None
+        return self.day_unit[n]
+
+    # The num journals (catalog journal numbers) whose centroids are closest to journal number code's, with their cosine scores
+    def related_journals(self, code, num=5):
+        scores = np.asarray((self.journal_unit @ self.journal_unit[code].T).toarray()).ravel()
+        scores[code] = -np.inf
+        scores[self.counts[:self.journals] == 0] = -np.inf
+        return select_top(scores, num, threshold=0)
+
+    # The num papers among ids (paper ids of journal number code) closest to the journal's centroid, with their cosine scores
+    def representative(self, vectors, ids, code, num=5):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return ids, np.array([])
+        scores = normalize_rows(vectors[ids - 1]) @ self.journal_unit[code].T
+        scores = np.asarray(scores.toarray() if sparse.issparse(scores) else scores).ravel()
+        top, top_scores = select_top(scores, num)
+        return ids[top], top_scores
+
+
+# Sums of the unit length rows start:stop of a matrix into groups - a (n_groups x features) sparse matrix. Every row is added to one group of each array in groups (e.g. its journal and its day)
+def group_sums(vectors, groups, n_groups, start, stop, chunk=CHUNK):
+    sums = sparse.csr_matrix((n_groups, vectors.shape[1]), dtype=np.float32)
+    for a in range(start, stop, chunk):
+        b = min(a + chunk, stop)
+        members = np.concatenate([x[a - start:b - start] for x in groups])
+        onehot = sparse.csr_matrix((np.ones(len(members)), (members, np.tile(np.arange(b - a), len(groups)))), shape=(n_groups, b - a))
+        sums = sums + sparse.csr_matrix(onehot @ normalize_rows(vectors[a:b]), dtype=np.float32)
+    return sums
+
+# Day number (index in days) of every paper id first to last, from the catalog's id blocks
+def day_numbers(cat, days, first, last):
+    numbers = np.zeros(last - first + 1, dtype=np.int64)
+    for day, a, b in cat.blocks:
+        if b >= first and a <= last:
+            numbers[max(a, first) - first:min(b, last) - first + 1] = np.searchsorted(days, day)
+    return numbers
+
+# Write the summaries state atomically
+def save(state, path=SUMMARIES_PATH):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+# Read a saved summaries state, None if there is none
+def read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+# Add rows n_old onwards of the similarity matrix (every row the paper catalog covers) to the saved summaries. They are rebuilt from every row if they do not cover exactly the n_old rows before them or belong to another feature space
+# If the saved state covers more rows (a run whose load failed), the previous state is extended instead
+def update(vectors, cat, n_old, path=SUMMARIES_PATH):
+    state = read(path)
+    current = state is not None and state['rows'] == n_old
+    if state is not None and state['rows'] > n_old:
+        state = read(path + '.prev')
+    if state is None or 'days' not in state or state['rows'] != n_old or state['space'] != config.FEATURE_SPACE or state['sums'].shape[1] != vectors.shape[1]:
+        state = {'rows': 0, 'space': config.FEATURE_SPACE, 'journals': 0, 'days': [], 'sums': sparse.csr_matrix((0, vectors.shape[1]), dtype=np.float32), 'counts': np.array([], dtype=np.int64)}
+    start, stop = state['rows'], cat.rows
+    days = sorted(set(state['days']) | set(cat.dates))
+    n_journals = len(cat.journals)
+
+    # Move the old rows into place (new journals and days get empty rows), then add the new papers
+    old_journals, old_days = state['journals'], state['days']
+    at = np.concatenate([np.arange(old_journals), n_journals + np.searchsorted(days, old_days)]).astype(np.int64)
+    moved = sparse.csr_matrix((np.ones(len(at)), (at, np.arange(len(at)))), shape=(n_journals + len(days), len(at)))
+    sums = sparse.csr_matrix(moved @ state['sums'], dtype=np.float32)
+    counts = np.zeros(n_journals + len(days), dtype=np.int64)
+    counts[at] = state['counts']
+    if stop > start:
+        codes = np.asarray(cat.codes[start:stop], dtype=np.int64)
+        day_rows = n_journals + day_numbers(cat, days, start + 1, stop)
+        sums = sums + group_sums(vectors, [codes, day_rows], n_journals + len(days), start, stop)
+        counts += np.bincount(codes, minlength=len(counts)) + np.bincount(day_rows, minlength=len(counts))
+    if current:
+        os.replace(path, path + '.prev')
+    save({'rows': stop, 'space': config.FEATURE_SPACE, 'journals': n_journals, 'days': days, 'sums': sparse.csr_matrix(sums), 'counts': counts}, path)
+
+# Load the summaries. Returns None if they have not been built, or do not cover the rows papers of the live features in their current feature space (dims columns)
+def load(rows=None, dims=None, path=SUMMARIES_PATH):
+    state = read(path)
+    if state is None or 'days' not in state:
+        return None
+    if (rows is not None and state['rows'] != rows) or state['space'] != config.FEATURE_SPACE or (dims is not None and state['sums'].shape[1] != dims):
+        return None
+    return Summaries(state['rows'], state['space'], state['journals'], state['days'], state['sums'], state['counts'])
@@ -0,0 +1,112 @@
+# Background tasks - debounced recomputation of a user's daily recommendations after their favorites change
+
+# Import relevant libraries
+
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+"""
+fave() schedules a recomputation instead of leaving it to the next user_home visit. Scheduling only starts a timer:
+toggling another favorite within config.RECOMPUTE_DELAY seconds restarts it with the new favorites, so a burst of
+toggles costs one recomputation. When the timer fires the task runs on a small thread pool (config.TASK_WORKERS),
+one task at a time per user.
+Each user's state is kept in a store under 'recs:<user id>' as {'token', 'ready', 'ids', 'scheduled'}: token identifies
+the favorites and day the recommendations are for, ready says whether ids were computed for that token (while a task is
+pending, ids are the last completed recommendations, which user_home keeps showing) and scheduled is when the task was
+scheduled (epoch seconds). A task still not done STALE_AFTER times the delay after that is taken to be lost with the
+process that scheduled it (a restart before its timer fired), and user_home computes the recommendations itself. The store is this process's memory
+by default; with config.REDIS_URL set it is Redis (or any server speaking its protocol), so every app process sees the
+results - the redis package is only needed then.
+"""
+
+STATE_TTL = 2 * 24 * 3600
+STALE_AFTER = 5
+
+
+# Store of task state in this process's memory
+class MemoryStore:
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+
+# Store of task state in Redis, shared by every app process
+class RedisStore:
+
+    def __init__(self, url, ttl=STATE_TTL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(key, json.dumps(value), ex=self.ttl)
+
+
+# Identifies the recommendations for a set of favorites on a day
+def token(fav_ids, day):
+    return hashlib.sha1((day + ':' + ','.join(str(x) for x in sorted(int(y) for y in fav_ids))).encode('utf-8')).hexdigest()
+
+
+class Recomputer:
+
+    def __init__(self, store=None, delay=None, workers=None):
+        self.store = store or (RedisStore(config.REDIS_URL) if config.REDIS_URL else MemoryStore())
+        self.delay = config.RECOMPUTE_DELAY if delay is None else delay
+        self.executor = ThreadPoolExecutor(max_workers=workers or config.TASK_WORKERS)
+        self.timers = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    # State of a user's recommendations, None if nothing was scheduled for them
+    def status(self, user):
+        return self.store.get('recs:' + str(user))
+
+    # Whether a state's task has been pending too long to still be running (at least a second, whatever the delay)
+    def stale(self, state):
+        return not state['ready'] and time.time() - state.get('scheduled', 0) > STALE_AFTER * max(self.delay, 1)
+
+    # Recompute a user's recommendations with fn(*args) after the debounce delay. The token says which favorites and day they are for
+    def schedule(self, user, task_token, fn, *args):
+        key = 'recs:' + str(user)
+        previous = self.store.get(key)
+        self.store.set(key, {'token': task_token, 'ready': False, 'ids': None if previous is None else previous['ids'], 'scheduled': time.time()})
+        with self.lock:
+            if key in self.timers:
+                self.timers[key].cancel()
+            timer = threading.Timer(self.delay, self.executor.submit, (self.run, key, task_token, fn, args))
+            timer.daemon = True
+            self.timers[key] = timer
+            self.locks.setdefault(key, threading.Lock())
+        timer.start()
+
+    # Run a recomputation and store its result, unless the favorites have changed again since it was scheduled. If it fails the token is cleared, so user_home computes the recommendations itself
+    def run(self, key, task_token, fn, args):
+        with self.locks[key]:
+            current = self.store.get(key)
+            if current is None or current['token'] != task_token:
+                return
+            try:
+                ids = fn(*args)
+            except:
+                self.store.set(key, {'token': None, 'ready': False, 'ids': current['ids'], 'scheduled': current.get('scheduled', 0)})
+                raise
+            current = self.store.get(key)
+            if current is not None and current['token'] == task_token:
+                self.store.set(key, {'token': task_token, 'ready': True, 'ids': [int(x) for x in ids], 'scheduled': current.get('scheduled', 0)})
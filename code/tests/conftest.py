@@ -0,0 +1,8 @@
+# Test setup - the modules live in code/ and are imported by name, as the scripts and the app do
+
+# Import relevant libraries
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,137 @@
+# Tests of the Springer fetcher against a local stub of the API serving a recorded day of Springer JSON
+
+# Import relevant libraries
+
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+import fetcher
+import text_pipeline
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'springer_2020-09-07.json')
+DAY = '2020-09-07'
+
+
+# Stub of the metadata API - serves the records of the fixture p at a time from record s, answers with the queued error codes of a start first, and logs the start of every request
+class StubAPI:
+
+    def __init__(self, total=True):
+        with open(FIXTURE) as f:
+            self.response = json.load(f)
+        if not total:
+            del self.response['result']
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                params = parse_qs(urlparse(self.path).query)
+                start, size = int(params['s'][0]), int(params['p'][0])
+                with stub.lock:
+                    stub.requests.append(start)
+                    queued = stub.failures.get(start, [])
+                    status = queued.pop(0) if queued else 200
+                body = json.dumps(dict(stub.response, records=stub.response['records'][start:start + size]) if status == 200 else {'error': status}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/metadata/json'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def api():
+    stub = StubAPI()
+    yield stub
+    stub.close()
+
+# Pages of 2 records, so the 5 records of the fixture take 3 pages
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(fetcher, 'PAGE', 2)
+
+# Fetcher for the stub, without rate limiting or backoff waits
+def stub_fetcher(url, checkpoint_dir, retries=3):
+    return fetcher.SpringerFetcher(base_url=url, api_key='test', rate=1000, burst=100, workers=2, retries=retries, backoff=0, checkpoint_dir=str(checkpoint_dir))
+
+# Titles of the records of the fixture
+def fixture_titles():
+    with open(FIXTURE) as f:
+        return sorted(x['title'] for x in json.load(f)['records'])
+
+
+def test_fetch_collects_every_page(api, tmp_path):
+    records = stub_fetcher(api.url, tmp_path).fetch(DAY)
+    assert sorted(x['title'] for x in records) == fixture_titles()
+    assert sorted(api.requests) == [0, 2, 4]
+    assert sorted(os.listdir(tmp_path / DAY)) == ['0.json', '2.json', '4.json']
+
+def test_fetched_records_pass_the_pipeline_filters(api, tmp_path):
+    records = stub_fetcher(api.url, tmp_path).fetch(DAY)
+    rows = [text_pipeline.to_row(x) for x in records]
+    assert all(text_pipeline.keep(x, DAY) for x in rows)
+    assert sorted(x['title'] for x in rows) == fixture_titles()
+
+def test_fetch_without_total_pages_until_a_short_page(tmp_path):
+    api = StubAPI(total=False)
+    try:
+        records = stub_fetcher(api.url, tmp_path).fetch(DAY)
+    finally:
+        api.close()
+    assert sorted(x['title'] for x in records) == fixture_titles()
+    assert api.requests == [0, 2, 4]
+
+def test_get_retries_5xx_and_429(api, tmp_path):
+    api.failures = {0: [503, 500], 2: [429]}
+    records = stub_fetcher(api.url, tmp_path).fetch(DAY)
+    assert len(records) == 5
+    assert api.requests.count(0) == 3
+    assert api.requests.count(2) == 2
+
+def test_get_gives_up_after_retries(api, tmp_path):
+    api.failures = {0: [502, 502, 502]}
+    with pytest.raises(requests.HTTPError):
+        stub_fetcher(api.url, tmp_path, retries=2).fetch(DAY)
+    assert api.requests == [0, 0, 0]
+    assert not os.path.exists(tmp_path / DAY / '0.json')
+
+def test_client_errors_are_not_retried(api, tmp_path):
+    api.failures = {0: [404]}
+    with pytest.raises(requests.HTTPError):
+        stub_fetcher(api.url, tmp_path).fetch(DAY)
+    assert api.requests == [0]
+
+def test_interrupted_run_resumes_from_checkpoints(api, tmp_path):
+    api.failures = {4: [500]}
+    with pytest.raises(requests.HTTPError):
+        stub_fetcher(api.url, tmp_path, retries=0).fetch(DAY)
+    assert sorted(os.listdir(tmp_path / DAY)) == ['0.json', '2.json']
+
+    api.requests = []
+    records = stub_fetcher(api.url, tmp_path).fetch(DAY)
+    assert sorted(x['title'] for x in records) == fixture_titles()
+    assert api.requests == [4]
+
+def test_clear_removes_the_checkpoints(api, tmp_path):
+    fetch = stub_fetcher(api.url, tmp_path)
+    fetch.fetch(DAY)
+    fetch.clear(DAY)
+    assert not os.path.exists(tmp_path / DAY)
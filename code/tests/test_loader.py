@@ -0,0 +1,105 @@
+# Tests of the bulk loader against a local SQLite database and a feature store in a temporary directory
+
+# Import relevant libraries
+
+import sqlite3
+import pandas as pd
+import pytest
+from scipy import sparse
+import feature_store
+import loader
+
+SCHEMA = "CREATE TABLE papers (title TEXT NOT NULL, abstract TEXT, link TEXT, date TEXT, journal TEXT, authors TEXT, id INT PRIMARY KEY)"
+
+
+# Papers table with n papers and a feature store whose one shard has a row for each of them
+@pytest.fixture
+def archive(tmp_path):
+    path = str(tmp_path / 'papers.db')
+    cnxn = sqlite3.connect(path)
+    cnxn.execute(SCHEMA)
+    cnxn.executemany(loader.INSERT, [row(x) for x in range(1, 4)])
+    cnxn.commit()
+    store_dir = str(tmp_path / 'features')
+    feature_store.append(sparse.random(3, 10, density=0.5, format='csr', random_state=0), 'base', store_dir)
+    yield cnxn, path, store_dir
+    cnxn.close()
+
+# Values of a papers row (in loader.INSERT order) for paper id
+def row(id):
+    return ('Title ' + str(id), 'Abstract ' + str(id), 'http://x/' + str(id), '2026-10-01', 'Journal', 'A | B', id)
+
+# DataFrame of the new papers first to last, as daily_collection.py passes them
+def new_papers(first, last):
+    return pd.DataFrame([row(x) for x in range(first, last + 1)], columns=['title', 'abstract', 'link', 'date', 'journal', 'authors', 'id'])
+
+# Function which publishes the new papers' feature rows
+def publisher(n, store_dir):
+    return lambda: feature_store.append(sparse.random(n, 10, density=0.5, format='csr', random_state=1), 'day', store_dir)
+
+# Paper ids in the papers table, in order
+def paper_ids(cnxn):
+    return [x[0] for x in cnxn.execute("SELECT id FROM papers ORDER BY id").fetchall()]
+
+
+def test_load_papers_inserts_and_publishes(archive):
+    cnxn, path, store_dir = archive
+    loader.load_papers(cnxn, new_papers(4, 5), publisher(2, store_dir), 3, store_dir)
+    assert paper_ids(sqlite3.connect(path)) == [1, 2, 3, 4, 5]
+    manifest = feature_store.read_manifest(store_dir)
+    assert [x['name'] for x in manifest['shards']] == ['base', 'day']
+    assert feature_store.load(store_dir).shape == (5, 10)
+
+def test_load_papers_refuses_ids_out_of_step(archive):
+    cnxn, path, store_dir = archive
+    published = []
+    with pytest.raises(RuntimeError, match='out of step'):
+        loader.load_papers(cnxn, new_papers(3, 4), lambda: published.append(True), 2, store_dir)
+    assert published == []
+    assert paper_ids(cnxn) == [1, 2, 3]
+    assert feature_store.read_manifest(store_dir)['version'] == 1
+
+def test_lock_max_id_blocks_other_writers(archive):
+    cnxn, path, store_dir = archive
+    cursor = cnxn.cursor()
+    assert loader.lock_max_id(cnxn, cursor) == 3
+    other = sqlite3.connect(path, timeout=0)
+    with pytest.raises(sqlite3.OperationalError):
+        other.execute(loader.INSERT, row(4))
+    cnxn.rollback()
+    other.execute(loader.INSERT, row(4))
+    other.commit()
+    assert paper_ids(cnxn) == [1, 2, 3, 4]
+
+def test_failed_insert_publishes_nothing(archive):
+    cnxn, path, store_dir = archive
+    df = new_papers(4, 5)
+    df.loc[1, 'title'] = None
+    published = []
+    with pytest.raises(sqlite3.IntegrityError):
+        loader.load_papers(cnxn, df, lambda: published.append(True), 3, store_dir)
+    assert published == []
+    assert paper_ids(cnxn) == [1, 2, 3]
+    assert feature_store.read_manifest(store_dir) == {'version': 1, 'shards': [{'name': 'base', 'rows': 3}]}
+
+def test_failed_publish_restores_the_manifest(archive):
+    cnxn, path, store_dir = archive
+    publish = publisher(2, store_dir)
+
+    # The features are published, then the second store's publish fails
+    def failing():
+        publish()
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        loader.load_papers(cnxn, new_papers(4, 5), failing, 3, store_dir)
+    assert paper_ids(sqlite3.connect(path)) == [1, 2, 3]
+    manifest = feature_store.read_manifest(store_dir)
+    assert manifest['version'] == 3
+    assert manifest['shards'] == [{'name': 'base', 'rows': 3}]
+    assert feature_store.load(store_dir).shape == (3, 10)
+
+    # The next run loads the same ids
+    loader.load_papers(cnxn, new_papers(4, 5), publish, 3, store_dir)
+    assert paper_ids(cnxn) == [1, 2, 3, 4, 5]
+    assert feature_store.load(store_dir).shape == (5, 10)
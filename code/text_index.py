@@ -0,0 +1,134 @@
+# Inverted index of the abstracts for the search page - lemmatized term to the sorted ids of the papers containing it, ranked by the papers' TF-IDF weights
+
+# Import relevant libraries
+
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+import text_pipeline
+
+"""
+The feature matrix already is a document-term matrix of the lemmatized abstracts, so the index is its transpose: the
+columns of the features in CSC form, saved as three .npy files in ../data/search:
+offsets.npy = int64, one entry per vectorizer term + 1 - term t's postings are rows[offsets[t]:offsets[t + 1]]
+rows.npy = int32 feature rows (paper id - 1) of every posting, ascending within each term
+weights.npy = float32 TF-IDF weight of the term in each of those papers
+shape.npy = (papers, terms) the index was built for
+Query words go through the same parser as the abstracts, so 'proteins' finds papers with 'protein'. Postings are
+intersected shortest first with searchsorted, summing the weights of the matched terms as each paper's score.
+Papers are added in id order, so the nightly update only appends the day's rows to the end of each posting list.
+Words the vectorizer has no column for (stop words, rare words) cannot be answered from the index, and are left to SQL.
+"""
+
+INDEX_DIR = '../data/search'
+
+
+class InvertedIndex:
+
+    def __init__(self, offsets, rows, weights, shape, vocabulary):
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.shape = shape
+        self.vocabulary = vocabulary
+
+    # Lemmatized tokens of a query word, in the form the vectorizer saw the abstracts
+    def tokens(self, word):
+        return [x for x in text_pipeline.parser(word).split() if len(x) > 0]
+
+    # Split query words into the index terms they contain and the words with a token the index does not know
+    def split(self, words):
+        terms, missing = [], []
+        for word in words:
+            tokens = self.tokens(word)
+            if len(tokens) > 0 and all(x in self.vocabulary for x in tokens):
+                terms += [self.vocabulary[x] for x in tokens]
+            else:
+                missing.append(word)
+        return sorted(set(terms)), missing
+
+    # Posting rows and weights of one term
+    def postings(self, term):
+        return self.rows[self.offsets[term]:self.offsets[term + 1]], self.weights[self.offsets[term]:self.offsets[term + 1]]
+
+    # Feature rows of the papers in rows start:stop containing every term (and in candidates - sorted feature rows - if given), best total weight first
+    def search(self, terms, start=0, stop=None, candidates=None):
+        stop = self.shape[0] if stop is None else stop
+        lists = sorted([self.postings(x) for x in terms], key=lambda x: len(x[0]))
+        rows, weights = lists[0]
+        at = np.searchsorted(rows, [start, stop])
+        rows, scores = np.asarray(rows[at[0]:at[1]]), np.asarray(weights[at[0]:at[1]], dtype=np.float64)
+        if candidates is not None:
+            keep = np.isin(rows, candidates, assume_unique=True)
+            rows, scores = rows[keep], scores[keep]
+        for posting_rows, posting_weights in lists[1:]:
+            if len(rows) == 0 or len(posting_rows) == 0:
+                return np.array([], dtype=np.int64)
+            at = np.minimum(np.searchsorted(posting_rows, rows), len(posting_rows) - 1)
+            keep = posting_rows[at] == rows
+            rows, scores = rows[keep], scores[keep] + posting_weights[at[keep]]
+        return rows[np.lexsort((-rows, -scores))].astype(np.int64)
+
+
+# Write the index arrays (each to a temporary file swapped in with os.replace, shape last)
+def save(offsets, rows, weights, shape, index_dir=INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    for key, value in [('offsets', offsets), ('rows', rows), ('weights', weights), ('shape', np.array(shape))]:
+        path = os.path.join(index_dir, key + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, value)
+        os.replace(path + '.tmp', path)
+
+# Open the index as memory maps. Returns None if it has not been built or does not cover the n_rows papers of the live features
+def load(n_rows=None, index_dir=INDEX_DIR, vectorizer_path=text_pipeline.VECTORIZER_PATH):
+    if not os.path.exists(os.path.join(index_dir, 'shape.npy')):
+        return None
+    shape = tuple(int(x) for x in np.load(os.path.join(index_dir, 'shape.npy')))
+    if n_rows is not None and shape[0] != n_rows:
+        return None
+    arrays = [np.load(os.path.join(index_dir, x + '.npy'), mmap_mode='r') for x in ['offsets', 'rows', 'weights']]
+    vocabulary = pickle.load(open(vectorizer_path, 'rb')).vocabulary_
+    return InvertedIndex(arrays[0], arrays[1], arrays[2], shape, vocabulary)
+
+# Postings of a block of feature rows (rows numbered from first), as (offsets, rows, weights)
+def invert(matrix, first=0):
+    matrix = sparse.csc_matrix(matrix)
+    matrix.sort_indices()
+    return matrix.indptr.astype(np.int64), (matrix.indices + first).astype(np.int32), matrix.data.astype(np.float32)
+
+# Add rows n_old: of the feature matrix to the index. Each term's new postings go after its old ones (new papers have the highest ids), so the merge is one pass over the arrays
+# If the stored index does not cover exactly n_old papers of the same vocabulary it is rebuilt from the whole matrix
+def update(features, n_old, index_dir=INDEX_DIR):
+    n, n_terms = features.shape
+    stored = None
+    if os.path.exists(os.path.join(index_dir, 'shape.npy')):
+        stored = tuple(int(x) for x in np.load(os.path.join(index_dir, 'shape.npy')))
+    if stored is None or stored[0] < n_old or stored[1] != n_terms:
+        n_old = 0
+    if n_old == 0:
+        offsets, rows, weights = invert(features[0:n])
+        save(offsets, rows, weights, (n, n_terms), index_dir)
+        return
+    old_offsets, old_rows, old_weights = [np.load(os.path.join(index_dir, x + '.npy'), mmap_mode='r') for x in ['offsets', 'rows', 'weights']]
+
+    # Postings of rows beyond n_old were added by a run whose load failed - drop them
+    if stored[0] > n_old:
+        keep = old_rows < n_old
+        kept_terms = np.repeat(np.arange(n_terms), np.diff(old_offsets))[keep]
+        old_offsets = np.concatenate([[0], np.cumsum(np.bincount(kept_terms, minlength=n_terms))]).astype(old_offsets.dtype)
+        old_rows, old_weights = old_rows[keep], old_weights[keep]
+    new_offsets, new_rows, new_weights = invert(features[n_old:n], n_old)
+
+    # Position of every old and new posting in the merged arrays
+    offsets = old_offsets + new_offsets
+    old_terms = np.repeat(np.arange(n_terms), np.diff(old_offsets))
+    new_terms = np.repeat(np.arange(n_terms), np.diff(new_offsets))
+    old_at = np.arange(len(old_rows)) + new_offsets[old_terms]
+    new_at = np.arange(len(new_rows)) + old_offsets[new_terms + 1]
+    rows = np.empty(offsets[-1], dtype=np.int32)
+    weights = np.empty(offsets[-1], dtype=np.float32)
+    rows[old_at], weights[old_at] = old_rows, old_weights
+    rows[new_at], weights[new_at] = new_rows, new_weights
+    del old_rows, old_weights
+    save(offsets, rows, weights, (n, n_terms), index_dir)
@@ -0,0 +1,116 @@
+# Text processing pipeline for the daily collection - cleaning, language detection, lemmatization and vectorization of the fetched records, run in a process pool while the fetcher is still downloading
+
+# Import relevant libraries
+
+import re
+import time
+import pickle
+import multiprocessing
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+from langdetect import detect
+from nltk.stem.wordnet import WordNetLemmatizer
+import config
+
+"""
+Pages of records are cut into chunks of CHUNK records and handed to worker processes as soon as they arrive. Each
+worker cleans its chunk, lemmatizes the abstracts (lemmas are memoized in a bounded LRU cache - a handful of words make
+up most of the text) and transforms the chunk with the pickled vectorizer. The parent then drops duplicate titles,
+sorts the papers by title and returns them with their feature rows in the same order.
+Throughput of each stage (fetch, clean + lemmatize, vectorize) is kept in a stats dictionary.
+"""
+
+VECTORIZER_PATH = '../data/vectorizer.csv'
+CHUNK = 100
+LEMMA_CACHE = 200000
+
+wl = WordNetLemmatizer()
+vec = None
+
+# Load the pickled vectorizer once per worker process
+def init_worker(vectorizer_path=VECTORIZER_PATH):
+    global vec
+    vec = pickle.load(open(vectorizer_path, 'rb'))
+
+# Try/except for the language detection - would ocasionally throw error which would halt collection process
+def detect_lang(text):
+    try:
+        return detect(text)
+    except:
+        return 'error'
+
+@lru_cache(maxsize=LEMMA_CACHE)
+def lemmatize(word):
+    return wl.lemmatize(word)
+
+# Function to remove non-alpha characters and lemmatize all words for a paper's abstract
+def parser(title):
+
+    '''Removes any non-alphabetical characters, converts to lower case, and lemmatizes each word in a document'''
+
+    letters = re.sub('[^a-zA-Z]', ' ', title)
+    letters = letters.lower()
+    words = re.split(r'\s+', letters)
+    words = [lemmatize(x) for x in words]
+    return (' '.join(words))
+
+# Convert a Springer API record into a row of paper data
+def to_row(record):
+    return {'title': str(record.get('title')), 'abstract': str(record.get('abstract')), 'link': str(record.get('url')[0].get('value')),
+            'date': str(record.get('publicationDate')), 'type': str(record.get('contentType')), 'journal': str(record.get('publicationName')),
+            'authors': ' | '.join([y.get('creator') for y in record.get('creators')])}
+
+# Data cleaning
+# Keep articles from the right date (API returns papers for the first days of each month for the year for some reason despite date search parameters). Remove papers not in English as well as those with empty or symbol-filled abstracts/titles. Removes redacted/corrected papers (low abstract character count)
+def keep(row, day):
+    return (row['type'] == 'Article' and row['date'] == day and '{' not in row['title'] and '???' not in row['abstract']
+            and len(row['abstract']) > 150 and detect_lang(row['title']) == 'en' and detect_lang(row['abstract']) == 'en')
+
+# Worker task - clean, lemmatize and vectorize one chunk of records. Returns the kept rows, their feature rows and the time spent on each stage
+def process_chunk(records, day):
+    start = time.perf_counter()
+    rows = [x for x in map(to_row, records) if keep(x, day)]
+    for row in rows:
+        row['p_abstract'] = parser(row['abstract'])
+    cleaned = time.perf_counter()
+    features = vec.transform([x['p_abstract'] for x in rows]) if len(rows) > 0 else None
+    return rows, features, cleaned - start, time.perf_counter() - cleaned
+
+# Run the pipeline over a stream of record pages (e.g. SpringerFetcher.pages). Returns a DataFrame of the kept papers sorted by title, their feature matrix (same row order) and the stage statistics
+def process(pages, day, workers=None, chunk=CHUNK, vectorizer_path=VECTORIZER_PATH):
+    stats = {'records': 0, 'papers': 0, 'fetch_seconds': 0.0, 'clean_seconds': 0.0, 'vectorize_seconds': 0.0}
+    futures = []
+    # Workers are forked (the daily collection is a plain script, which spawned workers would re-run). With fork every worker is started on the first submit - before the fetcher starts its download threads
+    with ProcessPoolExecutor(max_workers=workers or config.PIPELINE_WORKERS, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_worker, initargs=(vectorizer_path,)) as pool:
+        waited = time.perf_counter()
+        for records in pages:
+            stats['fetch_seconds'] += time.perf_counter() - waited
+            stats['records'] += len(records)
+            for x in range(0, len(records), chunk):
+                futures.append(pool.submit(process_chunk, records[x:x + chunk], day))
+            waited = time.perf_counter()
+        results = [x.result() for x in futures]
+
+    rows, matrices = [], []
+    for chunk_rows, chunk_features, clean_seconds, vectorize_seconds in results:
+        stats['clean_seconds'] += clean_seconds
+        stats['vectorize_seconds'] += vectorize_seconds
+        if len(chunk_rows) > 0:
+            rows += chunk_rows
+            matrices.append(chunk_features)
+    columns = ['title', 'abstract', 'link', 'date', 'type', 'authors', 'journal', 'p_abstract']
+    if len(rows) == 0:
+        init_worker(vectorizer_path)
+        return pd.DataFrame(columns=columns), sparse.csr_matrix((0, len(vec.vocabulary_))), stats
+
+    # Remove duplicate titles and sort by title, keeping the feature rows in step with the papers
+    df = pd.DataFrame(rows, columns=columns)
+    df = df[~df['title'].duplicated()]
+    df = df.iloc[np.argsort(df['title'].values, kind='stable')]
+    features = sparse.vstack(matrices, format='csr')[df.index.values]
+    stats['papers'] = len(df)
+    return df.reset_index(drop=True), features, stats